@@ -0,0 +1,80 @@
+"""
+Stampede-safe cache reads.
+
+cached() stores the value together with how long it took to compute and when it
+goes stale. Readers refresh it early with a probability that grows as the
+expiry approaches (XFetch), so a hot key is usually recomputed before it ever
+expires. Only the reader holding the per-key lock recomputes; everyone else
+keeps serving the stale value, which is kept for `stale_ttl` past the expiry.
+Readers that find nothing at all wait briefly for the lock holder instead of
+piling onto the database.
+"""
+
+import math
+import random
+import time
+
+from django.core.cache import cache
+
+
+LOCK_TIMEOUT = 30
+# How long a reader with nothing to serve waits for another worker's recompute
+WAIT_TIMEOUT = 2
+WAIT_INTERVAL = 0.05
+
+
+def _lock_key(key):
+    return f'{key}:lock'
+
+
+def _is_fresh(entry, beta):
+    # XFetch: the longer the recompute, the earlier a refresh may be triggered
+    early = entry['delta'] * beta * -math.log(1.0 - random.random())
+    return time.time() + early < entry['expires']
+
+
+def _recompute(key, compute, ttl, stale_ttl):
+    started = time.monotonic()
+    value = compute()
+    entry = {
+        'value': value,
+        'delta': time.monotonic() - started,
+        'expires': time.time() + ttl,
+    }
+    cache.set(key, entry, timeout=ttl + stale_ttl)
+    return value
+
+
+def cached(key, compute, ttl, stale_ttl=None, beta=1.0):
+    """
+    Return the cached value for `key`, calling `compute()` to (re)build it.
+
+    At most one caller per key recomputes at a time. `stale_ttl` (defaults to
+    `ttl`) is how long an expired value may still be served while that happens.
+    Exceptions raised by `compute` propagate and nothing is cached.
+    """
+    if stale_ttl is None:
+        stale_ttl = ttl
+
+    entry = cache.get(key)
+    if entry is not None and _is_fresh(entry, beta):
+        return entry['value']
+
+    lock_key = _lock_key(key)
+    if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        try:
+            return _recompute(key, compute, ttl, stale_ttl)
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        return entry['value']
+
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['value']
+    # The lock holder is too slow (or died); don't keep the client waiting
+    return _recompute(key, compute, ttl, stale_ttl)
@@ -0,0 +1,144 @@
+"""
+Production delivery of user uploads under /media/.
+
+With MEDIA_DELIVERY = "x-accel" or "x-sendfile" Django only checks the path and
+sets caching headers; the fronting server sends the bytes (and handles ranges
+and conditional requests itself). The default "stream" mode reads the file in
+small chunks off the event loop, answers If-None-Match / If-Modified-Since with
+304 and serves single byte ranges.
+
+Content-addressed names (a 64-char SHA-256 directory, see product/images.py)
+never change, so they are cached for a year as immutable.
+"""
+
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_AGE = 60 * 60
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+HASHED_NAME = re.compile(r'(^|/)[0-9a-f]{64}/')
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def _cache_control(path):
+    if HASHED_NAME.search(path):
+        return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f'public, max-age={MAX_AGE}'
+
+
+def _byte_range(header, size):
+    """
+    Parse a Range header into an inclusive (start, end), or None to send the whole file.
+
+    Multiple ranges and malformed headers are ignored, which the spec allows.
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # Suffix range: the last N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise RangeNotSatisfiable
+        start, end = max(size - suffix, 0), size - 1
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, end
+
+
+async def _read_chunks(full_path, start, length):
+    f = await asyncio.to_thread(open, full_path, 'rb')
+    try:
+        await asyncio.to_thread(f.seek, start)
+        while length > 0:
+            chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+@require_safe
+async def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    try:
+        st = await asyncio.to_thread(os.stat, full_path)
+    except OSError:
+        raise Http404
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    if content_type is None or encoding:
+        content_type = 'application/octet-stream'
+    headers = {'Cache-Control': _cache_control(path)}
+
+    if settings.MEDIA_DELIVERY == 'x-accel':
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(path)
+        return response
+    if settings.MEDIA_DELIVERY == 'x-sendfile':
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Sendfile'] = full_path
+        return response
+
+    etag = quote_etag(f'{st.st_mtime_ns:x}-{st.st_size:x}')
+    last_modified = int(st.st_mtime)
+    headers.update({'ETag': etag, 'Last-Modified': http_date(last_modified), 'Accept-Ranges': 'bytes'})
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        # 304 / 412, the validators and caching headers still apply
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    size, start, end, status = st.st_size, 0, st.st_size - 1, 200
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (if_range is None or if_range in (etag, headers['Last-Modified'])):
+        try:
+            byte_range = _byte_range(range_header, size)
+        except RangeNotSatisfiable:
+            headers['Content-Range'] = f'bytes */{size}'
+            return HttpResponse(status=416, headers=headers)
+        if byte_range is not None:
+            (start, end), status = byte_range, 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    headers['Content-Length'] = str(end - start + 1)
+    if request.method == 'HEAD':
+        return HttpResponse(status=status, content_type=content_type, headers=headers)
+    return StreamingHttpResponse(
+        _read_chunks(full_path, start, end - start + 1), status=status, content_type=content_type, headers=headers,
+    )
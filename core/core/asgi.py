@@ -13,12 +13,13 @@ django.setup()
 django_asgi_app = get_asgi_application()
 
 from live_chat.routing import websocket_urlpatterns
+from order.routing import websocket_urlpatterns as order_websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
-            websocket_urlpatterns
+            websocket_urlpatterns + order_websocket_urlpatterns
         )
     ),
 })
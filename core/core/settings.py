@@ -27,6 +27,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     # Third-party
     'rest_framework',
@@ -150,6 +151,16 @@ STATIC_ROOT = BASE_DIR / "staticfiles"  # used when you run collectstatic
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / "media"
+# Scheme and host of the absolute media URLs in API payloads, e.g. https://api.example.com.
+# Cached payloads are shared by every client, so they are built from this instead of the
+# Host header when it is set; empty = the request's own host
+SITE_ORIGIN = os.getenv('SITE_ORIGIN', '').rstrip('/')
+# How /media/ is delivered when DEBUG is off (see common/media.py):
+# "stream" reads the file in Django, "x-accel" (nginx) and "x-sendfile" (Apache, lighttpd)
+# hand it to the fronting server
+MEDIA_DELIVERY = os.getenv('MEDIA_DELIVERY', 'stream')
+# nginx `internal` location aliased to MEDIA_ROOT, used by "x-accel"
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv('MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
 
 # ====== EMAIL ======
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
@@ -213,6 +224,25 @@ SWAGGER_SETTINGS = {
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# ====== PRODUCT SEARCH ======
+# Text search configuration for Product.search_vector (PostgreSQL only).
+# 'simple' does no stemming, which suits mixed Russian/English menus.
+PRODUCT_SEARCH_CONFIG = os.getenv('PRODUCT_SEARCH_CONFIG', 'simple')
+# Minimum trigram word similarity for ?fuzzy=1 matches (pg_trgm default is 0.6)
+PRODUCT_FUZZY_THRESHOLD = float(os.getenv('PRODUCT_FUZZY_THRESHOLD', '0.3'))
+
+# ====== STOCK ======
+# Hold stock in Redis while it sits in a cart, for flash sales (see product/holds.py)
+STOCK_HOLDS_ENABLED = os.getenv('STOCK_HOLDS_ENABLED', 'False').lower() == 'true'
+STOCK_HOLD_TTL = int(os.getenv('STOCK_HOLD_TTL', '600'))  # seconds
+
+# ====== CHECKOUT ======
+# Queue checkouts in a Redis stream and place the orders in Celery (see order/checkout.py)
+CHECKOUT_QUEUE_ENABLED = os.getenv('CHECKOUT_QUEUE_ENABLED', 'False').lower() == 'true'
+CHECKOUT_WORKERS = int(os.getenv('CHECKOUT_WORKERS', '4'))  # drains running at once
+CHECKOUT_BATCH_SIZE = int(os.getenv('CHECKOUT_BATCH_SIZE', '20'))  # stream entries read at a time
+CHECKOUT_TICKET_TTL = int(os.getenv('CHECKOUT_TICKET_TTL', '3600'))  # seconds
+
 
 # ====== CELERY ======
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', REDIS_URL or 'redis://127.0.0.1:6379/0')
@@ -221,6 +251,33 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    # Write-behind "helpful" review votes (see product/helpful.py)
+    'flush-review-helpful-votes': {
+        'task': 'product.tasks.flush_review_helpful_votes',
+        'schedule': 30.0,
+    },
+    # Review ratings shown in the cached listings (see product/catalog.py)
+    'refresh-listed-ratings': {
+        'task': 'product.tasks.refresh_listed_ratings',
+        'schedule': 30.0,
+    },
+    # Expired cart stock holds (see product/holds.py)
+    'release-expired-stock-holds': {
+        'task': 'product.tasks.release_expired_stock_holds',
+        'schedule': 60.0,
+    },
+    # Stock buckets of high-contention products (see product/stock.py)
+    'rebalance-stock-buckets': {
+        'task': 'product.tasks.rebalance_stock_buckets',
+        'schedule': 30.0,
+    },
+    # Checkouts queued while every drain was finishing (see order/checkout.py)
+    'drain-checkout-queue': {
+        'task': 'order.tasks.drain_checkout_queue',
+        'schedule': 10.0,
+    },
+}
 
 
 
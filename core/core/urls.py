@@ -60,9 +60,9 @@ urlpatterns = [
 
 # Serve media files in production
 if not settings.DEBUG:
-    from django.views.static import serve
+    from common.media import serve_media
     urlpatterns += [
-        re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
+        re_path(r'^media/(?P<path>.*)$', serve_media),
     ]
 else:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
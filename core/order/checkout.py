@@ -0,0 +1,270 @@
+"""
+Order placement, synchronous or through the checkout queue.
+
+With CHECKOUT_QUEUE_ENABLED, CreateOrderView only checks that there is a cart
+and a valid delivery form, appends the request to a Redis stream and answers
+202 with a ticket. Celery workers (at most CHECKOUT_WORKERS at a time) read the
+stream as one consumer group, CHECKOUT_BATCH_SIZE entries at a time, so a
+surge queues up in Redis instead of holding a database connection per request.
+Each order still commits on its own: one transaction per batch would hold the
+stock row and bucket locks of every order until the last one is placed, and
+the drains would queue (or deadlock) on the hot products. The batch only saves
+round trips to Redis; the database sees at most CHECKOUT_WORKERS checkouts at
+once. The outcome is stored under the ticket for
+CheckoutStatusView and pushed to the customer's `checkout__<user id>` channels
+group (order.consumers).
+
+A worker that dies leaves its entries pending in the group; the next drain
+claims them once they have been idle for CLAIM_IDLE_MS. Orders carry their
+ticket, so an entry whose order was committed before the crash is answered
+with that order instead of being placed again.
+"""
+
+import json
+import logging
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+from rest_framework import status
+
+from product.holds import release_holds
+from product.stock import InsufficientStock, reserve_stock
+from user.models import MyUser
+
+from .models import Cart, Delivery, Order, OrderItem
+
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = 'checkout_stream'
+GROUP = 'checkout_workers'
+CLAIM_IDLE_MS = 60 * 1000
+# A drain refreshes its slot after every batch, a crashed one frees it after this
+SLOT_TIMEOUT = 60
+
+
+class CheckoutError(Exception):
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST, **extra):
+        self.status_code = status_code
+        self.detail = {'error': message, **extra}
+        super().__init__(message)
+
+
+def ticket_key(ticket):
+    return f'checkout_ticket:{ticket}'
+
+
+def pending_key(user_id):
+    return f'checkout_pending:{user_id}'
+
+
+def slot_key(slot):
+    return f'checkout_drain:{slot}'
+
+
+def create_order(user, cart, items, cart_total_price, delivery_data, checkout_ticket=None):
+    """
+    Turn `cart` into an order. `items` are its CartItems with their products, fetched once by the caller.
+
+    Must run inside transaction.atomic(), raises InsufficientStock.
+    """
+    # Остатки всех позиций списываются одним UPDATE; если чего-то не хватает, заказ откатывается
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    reserve_stock(quantities)
+    if settings.STOCK_HOLDS_ENABLED:
+        # Товар списан, удержания корзины больше не нужны
+        transaction.on_commit(lambda: release_holds(cart.id, quantities))
+
+    # Создаем заказ
+    order = Order.objects.create(
+        user=user,
+        total_price=cart_total_price,
+        status='new',
+        checkout_ticket=checkout_ticket
+    )
+
+    # Переносим товары из корзины в заказ одним INSERT, с ценой на момент покупки
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            product=item.product,
+            product_name=item.product.name,
+            unit_price=item.product.final_price,
+            quantity=item.quantity
+        )
+        for item in items
+    ])
+
+    user.balance -= cart_total_price
+    user.save()
+
+    is_free_delivery = True if cart_total_price >= 1000 else False
+    # Создаем информацию о доставке
+
+    Delivery.objects.create(
+        order=order,
+        delivery_type=delivery_data['delivery_type'],
+        receiver_name=delivery_data['receiver_name'],
+        receiver_phone_number=delivery_data['receiver_phone_number'],
+        delivery_address=delivery_data.get('delivery_address', ''),
+        description=delivery_data.get('description', ''),
+        is_free_delivery=is_free_delivery
+    )
+
+    cart.items.all().delete()
+    cart.is_active = False
+    cart.save()
+    transaction.on_commit(lambda: cache.delete(f'user_{user.id}_order_history'))
+    return order
+
+
+def place_order(user_id, delivery_data, ticket):
+    """Checkout of a queued request, with every check of CreateOrderView. Raises CheckoutError."""
+    # The balance is checked and charged under the user's row lock
+    user = MyUser.objects.select_for_update().get(pk=user_id)
+    cart = Cart.objects.filter(user=user, is_active=True).first()
+    if cart is None:
+        raise CheckoutError('Корзина не найдена', status.HTTP_404_NOT_FOUND)
+    items = list(cart.items.select_related('product'))
+    if not items:
+        raise CheckoutError('Корзина пуста')
+    cart_total_price = sum(item.total_price for item in items)
+    if user.balance < cart_total_price:
+        raise CheckoutError('Недостаточно средств на счету. Попробуйте еще раз.')
+    try:
+        return create_order(user, cart, items, cart_total_price, delivery_data, checkout_ticket=ticket)
+    except InsufficientStock as e:
+        raise CheckoutError('Недостаточно товара на складе', available={
+            str(product_id): units for product_id, units in e.available.items()
+        })
+
+
+def enqueue_checkout(user_id, delivery_data):
+    """Queue a checkout and return its ticket; a customer with a checkout in the queue gets that ticket back."""
+    ticket = uuid.uuid4().hex
+    if not cache.add(pending_key(user_id), ticket, settings.CHECKOUT_TICKET_TTL):
+        existing = cache.get(pending_key(user_id))
+        if existing:
+            return existing
+        cache.set(pending_key(user_id), ticket, settings.CHECKOUT_TICKET_TTL)
+    cache.set(ticket_key(ticket), {'user_id': user_id, 'status': 'queued'}, settings.CHECKOUT_TICKET_TTL)
+
+    get_redis_connection('default').xadd(STREAM_KEY, {
+        'ticket': ticket,
+        'user_id': user_id,
+        'delivery': json.dumps(delivery_data, ensure_ascii=False),
+    })
+    start_drain()
+    return ticket
+
+
+def start_drain():
+    """Queue a drain task if fewer than CHECKOUT_WORKERS are running."""
+    from .tasks import drain_checkout_queue
+
+    for slot in range(settings.CHECKOUT_WORKERS):
+        if cache.add(slot_key(slot), 1, SLOT_TIMEOUT):
+            drain_checkout_queue.delay(slot)
+            return True
+    return False
+
+
+def resume_drain():
+    """Start a drain if entries are waiting, e.g. queued while every drain was finishing."""
+    if get_redis_connection('default').xlen(STREAM_KEY):
+        return start_drain()
+    return False
+
+
+def get_ticket(ticket, user_id):
+    result = cache.get(ticket_key(ticket))
+    if result is None or result['user_id'] != user_id:
+        return None
+    return result
+
+
+def publish_result(ticket, user_id, result):
+    cache.set(ticket_key(ticket), {'user_id': user_id, **result}, settings.CHECKOUT_TICKET_TTL)
+    if cache.get(pending_key(user_id)) == ticket:
+        cache.delete(pending_key(user_id))
+    async_to_sync(get_channel_layer().group_send)(f'checkout__{user_id}', {
+        'type': 'checkout_result',
+        'ticket': ticket,
+        'result': result,
+    })
+
+
+def process_entries(entries):
+    """Place the orders of a batch of stream entries, each in its own transaction."""
+    for _, fields in entries:
+        ticket, user_id = fields['ticket'], int(fields['user_id'])
+        # Claimed again after its worker died: the outcome may be known, or the order placed
+        # and committed before the outcome was stored
+        current = cache.get(ticket_key(ticket))
+        if current and current['status'] != 'queued':
+            continue
+        placed = Order.objects.filter(checkout_ticket=ticket).values_list('id', flat=True).first()
+        if placed:
+            publish_result(ticket, user_id, {'status': 'done', 'order_id': placed})
+            continue
+        try:
+            with transaction.atomic():
+                order = place_order(user_id, json.loads(fields['delivery']), ticket)
+            result = {'status': 'done', 'order_id': order.id}
+        except CheckoutError as e:
+            result = {'status': 'failed', **e.detail}
+        except Exception:
+            logger.exception('Checkout %s failed', ticket)
+            result = {'status': 'failed', 'error': 'Не удалось оформить заказ'}
+        publish_result(ticket, user_id, result)
+
+
+def _ensure_group(redis):
+    try:
+        redis.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def _decode(entries):
+    # A claimed entry that was deleted meanwhile comes back without fields
+    return [
+        (entry_id, {key.decode(): value.decode() for key, value in fields.items()})
+        for entry_id, fields in entries if fields
+    ]
+
+
+def drain(slot):
+    """Place queued checkouts batch by batch until the stream is empty. Returns the number of entries handled."""
+    redis = get_redis_connection('default')
+    _ensure_group(redis)
+    consumer = f'drain-{slot}'
+    handled = 0
+    try:
+        while True:
+            # Entries of a crashed worker first, then new ones
+            _, entries, *_ = redis.xautoclaim(
+                STREAM_KEY, GROUP, consumer, CLAIM_IDLE_MS, start_id='0-0', count=settings.CHECKOUT_BATCH_SIZE,
+            )
+            if not entries:
+                response = redis.xreadgroup(GROUP, consumer, {STREAM_KEY: '>'}, count=settings.CHECKOUT_BATCH_SIZE)
+                entries = response[0][1] if response else []
+            if not entries:
+                return handled
+            process_entries(_decode(entries))
+            entry_ids = [entry_id for entry_id, _ in entries]
+            redis.xack(STREAM_KEY, GROUP, *entry_ids)
+            redis.xdel(STREAM_KEY, *entry_ids)
+            handled += len(entries)
+            cache.touch(slot_key(slot), SLOT_TIMEOUT)
+    finally:
+        cache.delete(slot_key(slot))
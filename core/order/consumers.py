@@ -0,0 +1,28 @@
+import json
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+
+class CheckoutConsumer(AsyncWebsocketConsumer):
+    """Pushes the outcome of the customer's queued checkouts (see order/checkout.py)"""
+
+    async def connect(self):
+        self.user = self.scope.get('user')
+        if not self.user or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.group_name = f'checkout__{self.user.id}'
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def checkout_result(self, event):
+        await self.send(text_data=json.dumps({
+            'action': 'checkout_result',
+            'data': {'ticket': event['ticket'], **event['result']},
+            'response_status': 200
+        }, ensure_ascii=False))
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-17 20:10
+
+from django.db import migrations, models
+from django.db.models import Case, F, OuterRef, Subquery, When
+
+
+def snapshot_prices(apps, schema_editor):
+    # The price paid was never stored, today's price (Product.final_price) is the best guess for old orders
+    OrderItem = apps.get_model('order', 'OrderItem')
+    Product = apps.get_model('product', 'Product')
+    product = Product.objects.filter(pk=OuterRef('product_id')).annotate(
+        final_price=Case(When(discounted_price__gt=0, then=F('discounted_price')), default=F('original_price')),
+    )
+    OrderItem.objects.update(
+        product_name=Subquery(product.values('name')[:1]),
+        unit_price=Subquery(product.values('final_price')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0007_order_status_timestamps_chat_group'),
+        ('product', '0026_stockbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_name',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.RunPython(snapshot_prices, migrations.RunPython.noop),
+    ]
@@ -31,6 +31,8 @@ class Order(models.Model):
     rating = PositiveSmallIntegerField(null=True, blank=True)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     is_active = models.BooleanField(default=True)
+    # Ticket of a queued checkout (order/checkout.py), so a replayed queue entry finds its order
+    checkout_ticket = models.CharField(max_length=32, null=True, blank=True, unique=True, editable=False)
 
 
     def __str__(self):
@@ -64,13 +66,16 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='order_items')
     quantity = models.PositiveIntegerField(default=1)
+    # Snapshot of the product when the order was placed, later price changes don't touch the order
+    product_name = models.CharField(max_length=255, default='')
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
 
     def __str__(self):
-        return f"{self.quantity} x {self.product.name} (Order: {self.order.id})"
+        return f"{self.quantity} x {self.product_name} (Order: {self.order_id})"
 
     @property
     def total_price(self):
-        return self.product.final_price * self.quantity
+        return self.unit_price * self.quantity
 
 
 # CART MODELS
@@ -1,9 +1,27 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from product.models import Product
-from product.serializers import ProductDetailSerializer, ProductListSerializer
+from product.serializers import ProductDetailSerializer, ProductListSerializer, primary_image_prefetch
 from .models import *
 
 
+def cart_items_prefetch():
+    """Loads a cart's items with everything CartSerializer nests, in a fixed number of queries"""
+    return [
+        Prefetch('items', queryset=CartItem.objects.select_related('product__category', 'product__company')),
+        primary_image_prefetch('items__product__'),
+    ]
+
+
+def order_items_prefetch():
+    """The same for the items of orders serialized with UserOrderHistorySerializer"""
+    return [
+        Prefetch('items', queryset=OrderItem.objects.select_related('product__category', 'product__company')),
+        primary_image_prefetch('items__product__'),
+        'deliveries',
+    ]
+
+
 class CartItemSerializer(serializers.ModelSerializer):
     product = ProductListSerializer()
     total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
@@ -37,7 +55,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = OrderItem
-        fields = ['id', 'product', 'quantity', 'total_price']
+        fields = ['id', 'product', 'product_name', 'unit_price', 'quantity', 'total_price']
 
 
 class DeliverySerializer(serializers.ModelSerializer):
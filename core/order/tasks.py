@@ -2,6 +2,8 @@ from celery import shared_task
 from django.core.mail import send_mail
 from django.conf import settings
 
+from .checkout import drain, resume_drain
+
 @shared_task
 def send_email_notification(user_email, message:str):
     send_mail(
@@ -10,4 +12,13 @@ def send_email_notification(user_email, message:str):
         from_email=settings.DEFAULT_FROM_EMAIL,
         recipient_list=[user_email],
         fail_silently=False,
-    )
\ No newline at end of file
+    )
+
+
+@shared_task(ignore_result=True)
+def drain_checkout_queue(slot=None):
+    # Without a slot (beat) only start a drain if something is waiting
+    if slot is None:
+        resume_drain()
+    else:
+        drain(slot)
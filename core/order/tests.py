@@ -1,3 +1,298 @@
-from django.test import TestCase
+import json
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+
+from product.holds import PRODUCTS_KEY, release_expired_holds, release_holds
+from product.models import Category, Company, Product, ProductImage
+from product.stock import rebalance_stock, release_stock, reserve_stock, set_stock_buckets
+from user.models import MyUser
+
+from .checkout import STREAM_KEY, drain, process_entries, slot_key, ticket_key
+from .models import Cart, CartItem, Order, OrderItem
+
+
+class CheckoutTestMixin:
+    url = '/api/order/create/'
+    delivery = {'delivery_type': 'pickup', 'receiver_name': 'Ann', 'receiver_phone_number': '+1000000000'}
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = MyUser.objects.create_user('buyer', 'buyer@example.com', 'pass')
+        self.user.balance = Decimal('100000.00')
+        self.user.save()
+        self.client.force_authenticate(self.user)
+
+        company = Company.objects.create(name='Burger House')
+        category = Category.objects.create(name='Burgers')
+        self.burger = Product.objects.create(
+            name='Cheeseburger', description='Beef', original_price=Decimal('1500.00'),
+            category=category, company=company, stock_quantity=3,
+        )
+        self.fries = Product.objects.create(
+            name='Fries', description='Potato', original_price=Decimal('500.00'),
+            category=category, company=company, stock_quantity=10,
+        )
+
+    def fill_cart(self, **quantities):
+        cart, _ = Cart.objects.get_or_create(user=self.user, is_active=True)
+        for name, quantity in quantities.items():
+            CartItem.objects.create(cart=cart, product=getattr(self, name), quantity=quantity)
+
+
+class CheckoutStockTestCase(CheckoutTestMixin, TestCase):
+
+    def test_checkout_takes_stock_and_cancel_returns_it(self):
+        self.fill_cart(burger=3, fries=2)
+        response = self.client.post(self.url, self.delivery, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.burger.refresh_from_db()
+        self.fries.refresh_from_db()
+        self.assertEqual((self.burger.stock_quantity, self.burger.is_available), (0, False))
+        self.assertEqual((self.fries.stock_quantity, self.fries.is_available), (8, True))
+
+        self.client.post(f'/api/order/{response.json()["id"]}/cancel/')
+        self.burger.refresh_from_db()
+        self.assertEqual((self.burger.stock_quantity, self.burger.is_available), (3, True))
+
+    def test_short_line_rolls_back_the_order(self):
+        self.fill_cart(burger=4, fries=2)
+        response = self.client.post(self.url, self.delivery, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['available'], {str(self.burger.id): 3})
+
+        self.fries.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(self.fries.stock_quantity, 10)
+        self.assertEqual(self.user.balance, Decimal('100000.00'))
+        self.assertFalse(Order.objects.exists())
+
+    def test_items_keep_the_price_paid(self):
+        self.burger.discounted_price = Decimal('1200.00')
+        self.burger.save()
+        self.fill_cart(burger=2, fries=1)
+        order_id = self.client.post(self.url, self.delivery, format='json').json()['id']
+
+        Product.objects.filter(pk=self.burger.pk).update(name='Double cheeseburger', discounted_price=None)
+        detail = self.client.get(f'/api/order/order_history_detail/{order_id}/').json()
+        self.assertEqual(detail['total_price'], '2900.00')
+        burger = next(item for item in detail['items'] if item['product']['id'] == self.burger.id)
+        self.assertEqual(
+            (burger['product_name'], burger['unit_price'], burger['total_price']),
+            ('Cheeseburger', '1200.00', '2400.00'),
+        )
+
+    def test_reduce_stock(self):
+        self.assertTrue(self.burger.reduce_stock(3))
+        self.assertEqual((self.burger.stock_quantity, self.burger.is_available), (0, False))
+        self.assertFalse(self.burger.reduce_stock(1))
+
+
+@override_settings(STOCK_HOLDS_ENABLED=True)
+class StockHoldTestCase(CheckoutStockTestCase):
+    def setUp(self):
+        super().setUp()
+        # Holds live in Redis, outside the test transaction
+        self.clear_holds()
+        self.addCleanup(self.clear_holds)
+        self.other = APIClient()
+        self.other.force_authenticate(MyUser.objects.create_user('rival', 'rival@example.com', 'pass'))
+
+    def clear_holds(self):
+        redis = get_redis_connection('default')
+        redis.delete(PRODUCTS_KEY, *redis.scan_iter('stock_hold:*'))
+
+    def put(self, client, quantity):
+        return client.put('/api/order/cart/', {'product_id': self.burger.id, 'quantity': quantity}, format='json')
+
+    def test_holds_reject_other_carts_until_released(self):
+        self.assertEqual(self.put(self.client, 2).status_code, status.HTTP_200_OK)
+        response = self.put(self.other, 2)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Доступно: 1', response.json()['error'])
+
+        # Shrinking the own hold frees the units for others
+        self.assertEqual(self.put(self.client, 1).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.put(self.other, 2).status_code, status.HTTP_200_OK)
+        self.client.post('/api/order/cart/clear/')
+        self.assertEqual(self.put(self.other, 3).status_code, status.HTTP_200_OK)
+
+    def test_checkout_turns_the_hold_into_a_decrement(self):
+        self.assertEqual(self.put(self.client, 2).status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, self.delivery, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.burger.refresh_from_db()
+        self.assertEqual(self.burger.stock_quantity, 1)
+        self.assertEqual(self.put(self.other, 1).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.put(self.other, 2).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expired_holds_are_swept(self):
+        with override_settings(STOCK_HOLD_TTL=-1):
+            self.assertEqual(self.put(self.client, 3).status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(release_expired_holds(), 1)
+        self.assertEqual(self.put(self.other, 3).status_code, status.HTTP_200_OK)
+        release_holds(Cart.objects.get(user__username='rival').id, [self.burger.id])
+
+
+class CartQueryCountTestCase(CheckoutTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for product in (self.burger, self.fries):
+            ProductImage.objects.create(product=product, image='products/images/front.jpg', is_primary=True)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_nested_products_cost_no_query_per_item(self):
+        self.fill_cart(burger=1)
+        urls = ['/api/order/cart/', '/api/product/main_page/']
+        queries = []
+        for url in urls:
+            # The first main page request also builds the catalog snapshot
+            self.count_queries(url)
+            queries.append(self.count_queries(url))
+        CartItem.objects.create(cart=Cart.objects.get(user=self.user), product=self.fries, quantity=1)
+        self.assertEqual([self.count_queries(url) for url in urls], queries)
+
+        order_id = self.client.post(self.url, self.delivery, format='json').json()['id']
+        url = f'/api/order/order_history_detail/{order_id}/'
+        count = self.count_queries(url)
+        OrderItem.objects.create(
+            order_id=order_id, product=self.burger, product_name='Cheeseburger', unit_price=Decimal('1500.00'),
+        )
+        self.assertEqual(self.count_queries(url), count)
+        items = self.client.get(url).json()['items']
+        self.assertEqual(len(items), 3)
+        self.assertTrue(all(item['product']['primary_image'] for item in items))
+
+
+class StockBucketTestCase(CheckoutTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(set_stock_buckets(self.burger.id, 3), 3)
+
+    def bucket_quantities(self):
+        return list(self.burger.buckets.order_by('index').values_list('quantity', flat=True))
+
+    def test_single_units_come_from_any_bucket(self):
+        self.assertEqual(self.bucket_quantities(), [1, 1, 1])
+        for _ in range(3):
+            self.assertTrue(self.burger.reduce_stock(1))
+        # The last single unit came from a bucket directly, the product is off sale right away
+        self.assertEqual((self.burger.stock_quantity, self.burger.is_available), (0, False))
+        self.assertFalse(self.burger.reduce_stock(1))
+        self.assertEqual(self.bucket_quantities(), [0, 0, 0])
+        self.assertEqual(rebalance_stock(self.burger.id), 0)
+
+    def test_checkout_drains_several_buckets(self):
+        self.fill_cart(burger=3, fries=2)
+        response = self.client.post(self.url, self.delivery, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.burger.refresh_from_db()
+        self.assertEqual((self.burger.stock_quantity, self.burger.is_available), (0, False))
+        self.assertEqual(self.bucket_quantities(), [0, 0, 0])
+
+    def test_short_line_reports_the_bucket_total(self):
+        with transaction.atomic():
+            reserve_stock({self.burger.id: 2})
+        self.fill_cart(burger=2)
+        response = self.client.post(self.url, self.delivery, format='json')
+        self.assertEqual(response.json()['available'], {str(self.burger.id): 1})
+
+    def test_saved_restock_goes_to_the_buckets(self):
+        burger = Product.objects.get(pk=self.burger.pk)
+        burger.stock_quantity = 7
+        burger.save()
+        self.assertEqual(self.bucket_quantities(), [3, 2, 2])
+        self.assertEqual(rebalance_stock(self.burger.id), 7)
+
+        # Saving other fields of a stale copy leaves the buckets alone
+        with transaction.atomic():
+            reserve_stock({self.burger.id: 2})
+        burger.name = 'Cheeseburger XL'
+        burger.save()
+        self.assertEqual(sum(self.bucket_quantities()), 5)
+
+    def test_release_and_rebalance(self):
+        with transaction.atomic():
+            reserve_stock({self.burger.id: 2})
+        release_stock({self.burger.id: 4})
+        self.assertEqual(sum(self.bucket_quantities()), 5)
+
+        self.assertEqual(rebalance_stock(self.burger.id), 5)
+        self.assertEqual(self.bucket_quantities(), [2, 2, 1])
+        self.burger.refresh_from_db()
+        self.assertEqual(self.burger.stock_quantity, 5)
+
+        self.assertEqual(set_stock_buckets(self.burger.id, 0), 5)
+        self.assertFalse(self.burger.buckets.exists())
+
+
+@override_settings(CHECKOUT_QUEUE_ENABLED=True)
+class CheckoutQueueTestCase(CheckoutTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        get_redis_connection('default').delete(STREAM_KEY)
+        cache.delete_many([slot_key(slot) for slot in range(settings.CHECKOUT_WORKERS)])
+        self.delay = self.enterContext(mock.patch('order.tasks.drain_checkout_queue.delay'))
+        self.push = self.enterContext(mock.patch('order.checkout.async_to_sync'))
+
+    def status(self, ticket):
+        return self.client.get(f'/api/order/checkout/{ticket}/')
+
+    def test_queued_checkout_is_placed_by_the_drain(self):
+        self.fill_cart(burger=2, fries=1)
+        response = self.client.post(self.url, self.delivery, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        ticket = response.json()['ticket']
+        self.delay.assert_called_once_with(0)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.status(ticket).json(), {'ticket': ticket, 'status': 'queued'})
+
+        self.assertEqual(drain(0), 1)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(self.status(ticket).json(), {'ticket': ticket, 'status': 'done', 'order_id': order.id})
+        self.assertEqual(order.total_price, Decimal('3500.00'))
+        self.burger.refresh_from_db()
+        self.assertEqual(self.burger.stock_quantity, 1)
+        self.assertEqual(self.push.return_value.call_args.args[0], f'checkout__{self.user.id}')
+
+    def test_replayed_entry_finds_its_order(self):
+        self.fill_cart(burger=1)
+        ticket = self.client.post(self.url, self.delivery, format='json').json()['ticket']
+        entry = ('1-0', {'ticket': ticket, 'user_id': str(self.user.id), 'delivery': json.dumps(self.delivery)})
+        process_entries([entry])
+        order = Order.objects.get()
+
+        # The worker died after the commit, before the outcome was stored
+        cache.set(ticket_key(ticket), {'user_id': self.user.id, 'status': 'queued'})
+        process_entries([entry])
+        self.assertEqual(self.status(ticket).json(), {'ticket': ticket, 'status': 'done', 'order_id': order.id})
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_checkout_and_repeated_submit(self):
+        self.fill_cart(burger=4)
+        ticket = self.client.post(self.url, self.delivery, format='json').json()['ticket']
+        self.assertEqual(self.client.post(self.url, self.delivery, format='json').json()['ticket'], ticket)
+
+        self.assertEqual(drain(0), 1)
+        result = self.status(ticket).json()
+        self.assertEqual((result['status'], result['available']), ('failed', {str(self.burger.id): 3}))
+        self.assertFalse(Order.objects.exists())
+
+        self.client.force_authenticate(MyUser.objects.create_user('other', 'other@example.com', 'pass'))
+        self.assertEqual(self.status(ticket).status_code, status.HTTP_404_NOT_FOUND)
@@ -8,6 +8,7 @@ urlpatterns = [
     
     # Order management
     path('create/', CreateOrderView.as_view(), name='create_order'),
+    path('checkout/<str:ticket>/', CheckoutStatusView.as_view(), name='checkout_status'),
     path('history/', UserOrderHistoryView.as_view(), name='user_order_history'),
     path('order_history_detail/<int:pk>/', OrderHistoryDetailView.as_view(), name='user_order_history_detail'),
     path('<int:pk>/rate/', OrderRateView.as_view(), name='rate_order'),
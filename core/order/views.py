@@ -1,17 +1,23 @@
+from django.conf import settings
 from django.core.cache import cache
 from drf_yasg.utils import swagger_auto_schema
 from django.utils import timezone
 from drf_yasg import openapi
+from common.cache import cached
 from common.permissions import IsCourier
+from product.holds import hold_stock, release_holds
+from product.stock import InsufficientStock, release_stock
 from rest_framework.generics import UpdateAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from .checkout import create_order, enqueue_checkout, get_ticket
 from .serializers import *
 from .models import Order, Cart
 from .tasks import send_email_notification
 from django.db import transaction
+from django.db.models import Sum, prefetch_related_objects
 from live_chat.models import Group
 
 
@@ -104,10 +110,21 @@ class OrderCancelView(APIView):
             }, status=status.HTTP_400_BAD_REQUEST)
 
         with transaction.atomic():
+            # A concurrent cancel must not refund and restock twice
+            order = Order.objects.select_for_update().get(pk=order.pk)
+            if order.status not in ['new', 'assigned']:
+                return Response({
+                    "error": f"Нельзя отменить заказ со статусом '{order.status}'"
+                }, status=status.HTTP_400_BAD_REQUEST)
+
             # Refund the money
             order.user.balance += order.total_price
             order.user.save()
 
+            # Return the stock
+            quantities = order.items.values('product_id').annotate(total=Sum('quantity'))
+            release_stock(dict(quantities.values_list('product_id', 'total')))
+
             # Update order status
             from django.utils import timezone
             order.status = 'cancelled'
@@ -146,18 +163,17 @@ class UserOrderHistoryView(APIView):
         }
     )
     def get(self, request):
-        cache_key = f'user_{request.user.id}_order_history'
-        data = cache.get(cache_key)
-
-        if data:
-            return Response(data, status=status.HTTP_200_OK)
-
-        # Get all user orders, not just delivered ones
-        orders = Order.objects.filter(user=request.user).order_by('-created_at')
-        serializer = UserOrderHistorySerializer(orders, many=True)
-        cache.set(cache_key, serializer.data, 60*5)
+        def serialize():
+            # Get all user orders, not just delivered ones
+            orders = (
+                Order.objects.filter(user=request.user)
+                .prefetch_related(*order_items_prefetch())
+                .order_by('-created_at')
+            )
+            return UserOrderHistorySerializer(orders, many=True).data
 
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        data = cached(f'user_{request.user.id}_order_history', serialize, ttl=60*5)
+        return Response(data, status=status.HTTP_200_OK)
 
 
 class CourierAvailableOrdersView(APIView):
@@ -249,33 +265,43 @@ class CreateOrderView(APIView):
     @swagger_auto_schema(
         tags=['Orders'],
         operation_id='orders_create',
-        operation_description="Создать заказ из корзины с информацией о доставке",
+        operation_description="Создать заказ из корзины с информацией о доставке. "
+                              "При включенной очереди (CHECKOUT_QUEUE_ENABLED) заказ оформляется асинхронно: "
+                              "возвращается тикет, результат - в /api/order/checkout/<ticket>/ и по WebSocket ws/checkout/",
         request_body=CreateOrderSerializer,
         responses={
             201: openapi.Response(
                 description="Заказ успешно создан",
                 schema=OrderSerializer
             ),
+            202: openapi.Response(
+                description="Заказ поставлен в очередь",
+                examples={"application/json": {"ticket": "3f2b9c0e5d8a4f6b9e1c7a2d4b6f8e0a", "status": "queued"}}
+            ),
             400: openapi.Response(description="Ошибка валидации или пустая корзина"),
             401: openapi.Response(description="Требуется аутентификация"),
             404: openapi.Response(description="Корзина не найдена")
         }
     )
     def post(self, request):
-        from django.db import transaction
-
         try:
             cart = Cart.objects.get(user=request.user, is_active=True)
-            if not cart.items.exists():
-                return Response({
-                    'error': 'Корзина пуста'
-                }, status=status.HTTP_400_BAD_REQUEST)
         except Cart.DoesNotExist:
             return Response({
                 'error': 'Корзина не найдена'
             }, status=status.HTTP_404_NOT_FOUND)
 
-        cart_total_price = sum(item.total_price for item in cart.items.all())
+        if settings.CHECKOUT_QUEUE_ENABLED:
+            return self.enqueue(request, cart)
+
+        # Items and their products are read once, for the total and for the order
+        items = list(cart.items.select_related('product'))
+        if not items:
+            return Response({
+                'error': 'Корзина пуста'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        cart_total_price = sum(item.total_price for item in items)
 
 
         if request.user.balance < cart_total_price:
@@ -283,51 +309,58 @@ class CreateOrderView(APIView):
 
         serializer = CreateOrderSerializer(data=request.data)
         if serializer.is_valid():
-            # Create order and deduct balance atomically
-            with transaction.atomic():
-                # Создаем заказ
-                order = Order.objects.create(
-                    user=request.user,
-                    total_price=sum(item.total_price for item in cart.items.all()),
-                    status='new'
-                )
-
-                # Переносим товары из корзины в заказ
-                for cart_item in cart.items.all():
-                    OrderItem.objects.create(
-                        order=order,
-                        product=cart_item.product,
-                        quantity=cart_item.quantity
-                    )
-
-                request.user.balance -= cart_total_price
-                request.user.save()
-
-                is_free_delivery = True if cart_total_price >= 1000 else False
-                # Создаем информацию о доставке
-
-                delivery_data = serializer.validated_data
-                Delivery.objects.create(
-                    order=order,
-                    delivery_type=delivery_data['delivery_type'],
-                    receiver_name=delivery_data['receiver_name'],
-                    receiver_phone_number=delivery_data['receiver_phone_number'],
-                    delivery_address=delivery_data.get('delivery_address', ''),
-                    description=delivery_data.get('description', ''),
-                    is_free_delivery=is_free_delivery
-                )
-
-                cart.items.all().delete()
-                cart.is_active = False
-                cart.save()
+            try:
+                # Create order, take the stock and deduct balance atomically
+                with transaction.atomic():
+                    order = create_order(request.user, cart, items, cart_total_price, serializer.validated_data)
+            except InsufficientStock as e:
+                return Response({
+                    'error': 'Недостаточно товара на складе',
+                    'available': e.available
+                }, status=status.HTTP_400_BAD_REQUEST)
 
             order_serializer = OrderSerializer(order)
-            cache.delete(f'user_{request.user.id}_order_history')
 
             return Response(order_serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def enqueue(self, request, cart):
+        # Balance and stock are checked by the worker placing the order
+        if not cart.items.exists():
+            return Response({
+                'error': 'Корзина пуста'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        serializer = CreateOrderSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        ticket = enqueue_checkout(request.user.id, serializer.validated_data)
+        return Response({'ticket': ticket, 'status': 'queued'}, status=status.HTTP_202_ACCEPTED)
+
+
+class CheckoutStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags=['Orders'],
+        operation_id='orders_checkout_status',
+        operation_description="Статус заказа, поставленного в очередь: queued, done (order_id) или failed (error)",
+        responses={
+            200: openapi.Response(
+                description="Статус тикета",
+                examples={"application/json": {"ticket": "3f2b9c0e5d8a4f6b9e1c7a2d4b6f8e0a", "status": "done", "order_id": 42}}
+            ),
+            401: openapi.Response(description="Требуется аутентификация"),
+            404: openapi.Response(description="Тикет не найден")
+        }
+    )
+    def get(self, request, ticket):
+        result = get_ticket(ticket, request.user.id)
+        if result is None:
+            return Response({'error': 'Тикет не найден'}, status=status.HTTP_404_NOT_FOUND)
+        result.pop('user_id')
+        return Response({'ticket': ticket, **result}, status=status.HTTP_200_OK)
+
 
 class OrderHistoryDetailView(APIView):
     permission_classes = [IsAuthenticated]
@@ -357,7 +390,7 @@ class OrderHistoryDetailView(APIView):
 
     def get(self, request, pk):
         try:
-            order = Order.objects.get(id=pk, user=request.user)
+            order = Order.objects.prefetch_related(*order_items_prefetch()).get(id=pk, user=request.user)
         except Order.DoesNotExist:
             return Response({'error': 'Заказ не найден'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -607,6 +640,7 @@ class CartView(APIView):
     def get(self, request):
         """Get user's active cart with all items"""
         cart, created = Cart.objects.get_or_create(user=request.user, is_active=True)
+        prefetch_related_objects([cart], *cart_items_prefetch())
         serializer = CartSerializer(cart)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -675,6 +709,14 @@ class CartView(APIView):
                 'error': f'Недостаточно товара на складе. Доступно: {product.stock_quantity}'
             }, status=status.HTTP_400_BAD_REQUEST)
 
+        # Hold the stock for this cart, other carts' holds count as taken
+        if settings.STOCK_HOLDS_ENABLED:
+            held, free = hold_stock(product.id, cart.id, quantity, product.stock_quantity)
+            if not held:
+                return Response({
+                    'error': f'Недостаточно товара на складе. Доступно: {free}'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
         cart_item, created = CartItem.objects.get_or_create(
             product=product,
             cart=cart,
@@ -688,6 +730,7 @@ class CartView(APIView):
                 cart_item.quantity = quantity
                 cart_item.save()
 
+        prefetch_related_objects([cart], *cart_items_prefetch())
         cart_serializer = CartSerializer(cart)
         return Response(cart_serializer.data, status=status.HTTP_200_OK)
 
@@ -728,11 +771,14 @@ class CartView(APIView):
         try:
             cart_item = CartItem.objects.get(cart=cart, product_id=product_id)
             cart_item.delete()
+            if settings.STOCK_HOLDS_ENABLED:
+                release_holds(cart.id, [cart_item.product_id])
         except CartItem.DoesNotExist:
             return Response({
                 'error': 'Товар не найден в корзине'
             }, status=status.HTTP_404_NOT_FOUND)
 
+        prefetch_related_objects([cart], *cart_items_prefetch())
         cart_serializer = CartSerializer(cart)
         return Response(cart_serializer.data, status=status.HTTP_200_OK)
 
@@ -753,6 +799,8 @@ class ClearCartView(APIView):
         """Clear all items from cart"""
         try:
             cart = Cart.objects.get(user=request.user, is_active=True)
+            if settings.STOCK_HOLDS_ENABLED:
+                release_holds(cart.id, cart.items.values_list('product_id', flat=True))
             cart.items.all().delete()
             return Response({
                 'message': 'Корзина очищена'
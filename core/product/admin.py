@@ -4,4 +4,5 @@ from .models import *
 admin.site.register(Category)
 admin.site.register(Product)
 admin.site.register(Company)
+admin.site.register(Tag)
 # Register your models here.
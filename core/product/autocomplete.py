@@ -0,0 +1,96 @@
+"""
+In-process prefix index for search-as-you-type.
+
+Product names, product tags and restaurant names are kept as sorted arrays of
+normalized keys, so a keystroke is a binary search plus a short scan and never
+touches the database. The index is rebuilt when the catalog version changes.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from .catalog import get_catalog_version
+from .models import Company, Product, Tag
+from .search import tokenize
+
+
+# Lower sorts first when matches are otherwise equal
+KIND_PRIORITY = {'product': 0, 'restaurant': 1, 'tag': 2}
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+class PrefixIndex:
+    # Don't hit the cache for the version on every keystroke
+    version_check_interval = 1.0
+    # How many key matches to look at before ranking
+    scan_limit = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # (sorted keys, entries) swapped in as one tuple so readers never see a half-built index
+        self._index = ([], [])
+
+    def lookup(self, prefix, limit=10):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self.ensure_fresh()
+
+        keys, entries = self._index
+        matches = {}
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix) and len(matches) < self.scan_limit:
+            entry = entries[i]
+            key = (entry['type'], entry['id'], entry['text'])
+            # An entry matching from its first word ranks above a match on a later word
+            from_start = normalize(entry['text']).startswith(prefix)
+            if key not in matches or from_start:
+                matches[key] = (entry, from_start)
+            i += 1
+
+        ranked = sorted(
+            matches.values(),
+            key=lambda match: (not match[1], KIND_PRIORITY[match[0]['type']], len(match[0]['text']), match[0]['text']),
+        )
+        return [entry for entry, _ in ranked[:limit]]
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.version_check_interval:
+            return
+        self._checked_at = now
+
+        version = get_catalog_version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self.build()
+                    self._version = version
+
+    def build(self):
+        suggestions = []
+        for pk, name in Product.objects.values_list('id', 'name').iterator(chunk_size=2000):
+            suggestions.append({'type': 'product', 'id': pk, 'text': name})
+        for pk, name in Company.objects.values_list('id', 'name'):
+            suggestions.append({'type': 'restaurant', 'id': pk, 'text': name})
+        for pk, name in Tag.objects.filter(products__isnull=False).distinct().values_list('id', 'name'):
+            suggestions.append({'type': 'tag', 'id': pk, 'text': name})
+
+        # Index every word position so "burger" also finds "Chicken Burger"
+        pairs = []
+        for entry in suggestions:
+            words = tokenize(entry['text'])
+            for start in range(len(words)):
+                pairs.append((' '.join(words[start:]), entry))
+        pairs.sort(key=lambda pair: pair[0])
+
+        self._index = ([key for key, _ in pairs], [entry for _, entry in pairs])
+
+
+prefix_index = PrefixIndex()
@@ -0,0 +1,54 @@
+"""
+Set-based catalog mutations.
+
+apply_product_patch() changes price, stock and availability of every product
+in a queryset with one UPDATE, instead of saving the rows one by one. Queryset
+updates skip post_save, so the catalog snapshots and the affected product
+details are invalidated here, once, after commit.
+"""
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from .catalog import bump_catalog_version, invalidate_product_details
+from .models import Product
+from .stock import reset_bucket_stock
+
+
+def patch_updates(patch):
+    """Turn a validated patch into the keyword arguments of QuerySet.update()."""
+    updates = {}
+    if 'discounted_price' in patch:
+        updates['discounted_price'] = patch['discounted_price']
+    if 'discount_percent' in patch:
+        percent = patch['discount_percent']
+        factor = (Decimal(100) - percent) / Decimal(100)
+        updates['discounted_price'] = Round(F('original_price') * factor, 2) if percent else None
+    if 'stock_quantity' in patch:
+        updates['stock_quantity'] = patch['stock_quantity']
+        # Same rule as Product.reduce_stock and release_stock: running out makes the product
+        # unavailable, a restock puts it back on sale. An explicit is_available below wins
+        updates['is_available'] = patch['stock_quantity'] > 0
+    if 'is_available' in patch:
+        updates['is_available'] = patch['is_available']
+    return updates
+
+
+def apply_product_patch(queryset, patch):
+    """Apply `patch` to every product in `queryset`. Returns the number of products changed."""
+    updates = patch_updates(patch)
+    with transaction.atomic():
+        # Lock only the product rows, the filter may join categories
+        ids = list(queryset.select_for_update(of=('self',)).values_list('id', flat=True))
+        if not ids:
+            return 0
+        Product.objects.filter(pk__in=ids).update(**updates, updated_at=timezone.now())
+        if 'stock_quantity' in patch:
+            reset_bucket_stock(dict.fromkeys(ids, patch['stock_quantity']))
+        transaction.on_commit(bump_catalog_version)
+        transaction.on_commit(lambda: invalidate_product_details(ids))
+    return len(ids)
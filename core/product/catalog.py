@@ -0,0 +1,258 @@
+"""
+Versioned, pre-serialized catalog snapshot used by the main page.
+
+The categories + products payload is built once per catalog version and stored
+in the cache as pre-encoded JSON bytes. Any change to Product, Category,
+Company, Tag or ProductImage bumps the version (see product/signals.py), so
+stale snapshots are simply never read again and expire on their own.
+
+The id pools behind the random product pick are versioned the same way.
+
+Ratings change with every review, far more often than the rest of the
+catalog, so they don't bump the catalog version. A review only marks them
+dirty (mark_ratings_changed), and refresh_ratings(), run by Celery beat, moves
+the separate ratings version at most once per run. It is part of the keys of
+the listings that show ratings (the main page snapshot and the restaurant
+list), so these pick up new ratings within a beat interval while the category
+tree, the random pools and the search and autocomplete indexes are left alone.
+
+Product detail payloads are cached per product instead and purged explicitly
+whenever that product (or its company) changes, so they can live for hours.
+
+Cached payloads hold absolute image URLs. With SITE_ORIGIN set they are built
+through site_request() from that origin, so a forged Host header can neither
+end up in a payload served to others nor mint a fresh cache key per request.
+"""
+
+import json
+import random
+import time
+from array import array
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Product, Category
+from .serializers import CategoryListSerializer, ProductListSerializer, primary_image_prefetch
+
+
+CATALOG_VERSION_KEY = 'catalog_version'
+RATINGS_VERSION_KEY = 'ratings_version'
+RATINGS_DIRTY_KEY = 'ratings_dirty'
+CATALOG_SNAPSHOT_TIMEOUT = 60 * 60 * 24
+RANDOM_POOL_TIMEOUT = 60 * 60 * 24
+PRODUCT_DETAIL_TIMEOUT = 60 * 60 * 6
+
+
+def _initial_version():
+    # Seeded from the clock so a flushed cache never reissues a version that
+    # in-process indexes may already have been built for
+    return int(time.time() * 1000)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Key is missing (cache flushed or never initialised)
+        cache.add(key, _initial_version(), timeout=None)
+        return cache.incr(key)
+
+
+def get_catalog_version():
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """Invalidate every catalog snapshot by moving to a new version."""
+    return _bump_version(CATALOG_VERSION_KEY)
+
+
+def get_listing_version():
+    """Version of the cached listings that show ratings: the catalog's and the ratings' together."""
+    versions = cache.get_many([CATALOG_VERSION_KEY, RATINGS_VERSION_KEY])
+    catalog = versions.get(CATALOG_VERSION_KEY) or get_catalog_version()
+    ratings = versions.get(RATINGS_VERSION_KEY) or _get_version(RATINGS_VERSION_KEY)
+    return f'{catalog}.{ratings}'
+
+
+def mark_ratings_changed():
+    cache.set(RATINGS_DIRTY_KEY, 1, timeout=None)
+
+
+def refresh_ratings():
+    """Move the ratings version if a review changed since the last run. Returns whether it did."""
+    # delete() reports whether the key was there, so two runs can't both see it
+    if not cache.delete(RATINGS_DIRTY_KEY):
+        return False
+    _bump_version(RATINGS_VERSION_KEY)
+    return True
+
+
+def product_detail_key(product_id):
+    return f'product_detail_{product_id}'
+
+
+def invalidate_product_details(product_ids):
+    """Drop the cached detail payloads of the given products."""
+    cache.delete_many([product_detail_key(product_id) for product_id in product_ids])
+
+
+class SiteRequest:
+    """A request whose absolute URLs are built from SITE_ORIGIN rather than its Host header."""
+
+    def __init__(self, request):
+        self._request = request
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def build_absolute_uri(self, location=None):
+        if location is None:
+            location = self._request.get_full_path()
+        return urljoin(f'{settings.SITE_ORIGIN}/', location)
+
+
+def site_request(request):
+    """The request to serialize cached payloads with."""
+    return SiteRequest(request) if settings.SITE_ORIGIN else request
+
+
+def site_origin(request):
+    # Image URLs are absolute, so cached payloads depend on scheme and host
+    return settings.SITE_ORIGIN or f'{request.scheme}://{request.get_host()}'
+
+
+def _snapshot_key(request, version, category_id, tag, category_tree):
+    return (
+        f'catalog_snapshot_v{version}_{site_origin(request)}_{category_id or "all"}_{tag or "all"}'
+        f'_{category_tree or "all"}'
+    )
+
+
+def filter_category_subtree(products, category_id):
+    """Restrict `products` to the category and all of its descendants."""
+    path = Category.objects.filter(pk=category_id).values_list('path', flat=True).first()
+    if path is None:
+        return products.none()
+    return products.filter(category__path__startswith=path)
+
+
+def build_catalog_snapshot(request, category_id=None, tag=None, category_tree=None):
+    """Serialize categories and products into a JSON object body without braces."""
+    categories = Category.objects.all()
+    products = Product.objects.select_related('category', 'company').prefetch_related(primary_image_prefetch())
+    if category_id:
+        products = products.filter(category_id=category_id)
+    if tag:
+        products = products.filter(tag_set__name=tag)
+    if category_tree:
+        products = filter_category_subtree(products, category_tree)
+
+    context = {'request': site_request(request)}
+    data = {
+        'categories': CategoryListSerializer(categories, many=True, context=context).data,
+        'products': ProductListSerializer(products, many=True, context=context).data,
+    }
+    encoded = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+    # Strip the outer braces so the view can splice in per-user fields
+    return encoded[1:-1].encode('utf-8')
+
+
+def get_catalog_snapshot(request, category_id=None, tag=None, category_tree=None):
+    """
+    Return the pre-encoded categories + products fragment for the current catalog version.
+
+    Costs a single cache read on a hit; rebuilds and stores the fragment on a miss.
+    `tag` must already be normalized (see parse_tags).
+    """
+    key = _snapshot_key(request, get_listing_version(), category_id, tag, category_tree)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build_catalog_snapshot(request, category_id, tag, category_tree)
+        cache.set(key, snapshot, timeout=CATALOG_SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def build_category_tree(request):
+    """Nested category tree with direct and subtree product counts, from a single query."""
+    categories = list(Category.objects.annotate(product_count=Count('products')).order_by('path'))
+    image_data = CategoryListSerializer(categories, many=True, context={'request': site_request(request)}).data
+
+    nodes, roots = {}, []
+    for category, data in zip(categories, image_data):
+        node = nodes[category.id] = {
+            'id': category.id,
+            'name': category.name,
+            'image': data['image'],
+            'image_variants': data['image_variants'],
+            'depth': category.depth,
+            'product_count': category.product_count,
+            'total_product_count': category.product_count,
+            'children': [],
+        }
+        # Ordered by path, so a parent is always seen before its children
+        parent = nodes.get(category.parent_category_id)
+        (parent['children'] if parent else roots).append(node)
+
+    for category in reversed(categories):
+        parent = nodes.get(category.parent_category_id)
+        if parent:
+            parent['total_product_count'] += nodes[category.id]['total_product_count']
+    return roots
+
+
+def get_category_tree(request):
+    key = f'category_tree_v{get_catalog_version()}_{site_origin(request)}'
+    tree = cache.get(key)
+    if tree is None:
+        tree = build_category_tree(request)
+        cache.set(key, tree, timeout=CATALOG_SNAPSHOT_TIMEOUT)
+    return tree
+
+
+def _random_pool_key(version, available, category_id, company_id):
+    return f'random_pool_v{version}_{int(available)}_{category_id or "all"}_{company_id or "all"}'
+
+
+def get_random_pool(available=False, category_id=None, company_id=None):
+    """Return the ids of the products matching the filters as a compact array, cached per catalog version."""
+    key = _random_pool_key(get_catalog_version(), available, category_id, company_id)
+    pool = cache.get(key)
+    if pool is None:
+        products = Product.objects.all()
+        if available:
+            products = products.filter(is_available=True)
+        if category_id:
+            products = products.filter(category_id=category_id)
+        if company_id:
+            products = products.filter(company_id=company_id)
+        pool = array('q', products.order_by('id').values_list('id', flat=True).iterator(chunk_size=5000))
+        cache.set(key, pool, timeout=RANDOM_POOL_TIMEOUT)
+    return pool
+
+
+def pick_random_product(available=False, category_id=None, company_id=None, attempts=3):
+    """
+    Return a random product matching the filters, or None when there is none.
+
+    Picks an id from the cached pool and loads just that row.
+    """
+    pool = get_random_pool(available, category_id, company_id)
+    for _ in range(min(attempts, len(pool))):
+        product = Product.objects.select_related('category', 'company').filter(pk=random.choice(pool)).first()
+        # A miss means the row was deleted and the version bump has not landed yet
+        if product is not None:
+            return product
+    return None
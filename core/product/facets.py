@@ -0,0 +1,83 @@
+"""
+Facet counts for product search.
+
+All four facets (category, company, price bucket, rating bucket) come from a
+single GROUP BY over their combination; the per-facet totals are folded
+together in Python. The number of groups is bounded by
+categories x companies x buckets, not by the number of products.
+"""
+
+from django.db.models import CharField, Count, Q, Value, When, Case
+
+
+# (label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = [
+    ('0-500', None, 500),
+    ('500-1000', 500, 1000),
+    ('1000-2000', 1000, 2000),
+    ('2000-5000', 2000, 5000),
+    ('5000+', 5000, None),
+]
+
+RATING_BUCKETS = [
+    ('4+', 4, None),
+    ('3-4', 3, 4),
+    ('2-3', 2, 3),
+    ('1-2', 1, 2),
+    ('0-1', None, 1),
+]
+UNRATED = 'unrated'
+
+
+def _bucket_case(field, buckets, default=None):
+    whens = []
+    for label, low, high in buckets:
+        condition = Q()
+        if low is not None:
+            condition &= Q(**{f'{field}__gte': low})
+        if high is not None:
+            condition &= Q(**{f'{field}__lt': high})
+        whens.append(When(condition, then=Value(label)))
+    return Case(*whens, default=Value(default), output_field=CharField())
+
+
+def compute_facets(queryset):
+    # Prices are bucketed on original_price to agree with the min_price/max_price filters
+    rows = (
+        queryset.order_by()
+        .values(
+            'category_id', 'category__name', 'company_id', 'company__name',
+            price_bucket=_bucket_case('original_price', PRICE_BUCKETS),
+            rating_bucket=_bucket_case('rating', RATING_BUCKETS, default=UNRATED),
+        )
+        .annotate(count=Count('id'))
+    )
+
+    categories, companies = {}, {}
+    prices = dict.fromkeys((label for label, _, _ in PRICE_BUCKETS), 0)
+    ratings = dict.fromkeys([label for label, _, _ in RATING_BUCKETS] + [UNRATED], 0)
+
+    for row in rows:
+        count = row['count']
+        category = categories.setdefault(row['category_id'], {
+            'id': row['category_id'], 'name': row['category__name'], 'count': 0,
+        })
+        category['count'] += count
+        if row['company_id'] is not None:
+            company = companies.setdefault(row['company_id'], {
+                'id': row['company_id'], 'name': row['company__name'], 'count': 0,
+            })
+            company['count'] += count
+        prices[row['price_bucket']] += count
+        ratings[row['rating_bucket']] += count
+
+    by_count = lambda item: (-item['count'], item['name'] or '')
+    return {
+        'category': sorted(categories.values(), key=by_count),
+        'company': sorted(companies.values(), key=by_count),
+        'price': [
+            {'bucket': label, 'min': low, 'max': high, 'count': prices[label]}
+            for label, low, high in PRICE_BUCKETS
+        ],
+        'rating': [{'bucket': label, 'count': count} for label, count in ratings.items()],
+    }
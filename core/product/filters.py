@@ -0,0 +1,35 @@
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+from .search import get_search_backend
+
+
+class ProductSearchFilter(BaseFilterBackend):
+    """
+    Full-text search that annotates each match with a relevance `rank`.
+    With ?fuzzy=1 the term is matched by trigram similarity instead, so typos still hit.
+    """
+    search_param = 'search'
+    fuzzy_param = 'fuzzy'
+
+    def get_search_term(self, request):
+        return request.query_params.get(self.search_param, '').strip()
+
+    def is_fuzzy(self, request):
+        return request.query_params.get(self.fuzzy_param, '').lower() in ('1', 'true')
+
+    def filter_queryset(self, request, queryset, view):
+        term = self.get_search_term(request)
+        if not term:
+            return queryset
+        if self.is_fuzzy(request):
+            return get_search_backend().fuzzy_search(queryset, term)
+        return get_search_backend().search(queryset, term)
+
+
+class RelevanceOrderingFilter(OrderingFilter):
+    """Orders search results by relevance unless an explicit ordering is requested."""
+
+    def get_default_ordering(self, view):
+        if ProductSearchFilter().get_search_term(view.request):
+            return ['-rank']
+        return super().get_default_ordering(view)
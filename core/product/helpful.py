@@ -0,0 +1,92 @@
+"""
+Write-behind counter for "was this review helpful" votes.
+
+A vote is a SADD into the review's voter set (which dedups per user) and, when
+the user is new, an HINCRBY on a shared hash of pending deltas. The periodic
+flush_helpful_votes task moves the hash aside with RENAME and applies all the
+deltas to ProductReview.helpful_count in one UPDATE, so a viral review never
+turns into a stream of single-row updates. Reads add the pending deltas on top
+of the stored counts.
+
+Only one flush runs at a time (a cache lock), and the moved-aside hash is
+dropped when the UPDATE commits, so a flush that failed before committing is
+simply retried with the same deltas.
+"""
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django_redis import get_redis_connection
+
+from .models import ProductReview
+
+
+PENDING_KEY = 'review_helpful_pending'
+# Holds the deltas of a flush in progress; left behind if a flush fails and retried first next time
+FLUSHING_KEY = 'review_helpful_flushing'
+FLUSH_LOCK_KEY = 'review_helpful_flush_lock'
+FLUSH_LOCK_TIMEOUT = 60 * 5
+
+
+def _voters_key(review_id):
+    return f'review_helpful_voters:{review_id}'
+
+
+def vote_helpful(review_id, user_id):
+    """Record a helpful vote. Returns False if the user already voted for the review."""
+    redis = get_redis_connection('default')
+    if not redis.sadd(_voters_key(review_id), user_id):
+        return False
+    redis.hincrby(PENDING_KEY, review_id, 1)
+    return True
+
+
+def pending_helpful_counts(review_ids):
+    """Deltas not yet flushed to the database, keyed by review id."""
+    review_ids = list(review_ids)
+    if not review_ids:
+        return {}
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline(transaction=False)
+    pipe.hmget(PENDING_KEY, review_ids)
+    pipe.hmget(FLUSHING_KEY, review_ids)
+    pending, flushing = pipe.execute()
+
+    counts = {}
+    for review_id, *deltas in zip(review_ids, pending, flushing):
+        total = sum(int(delta) for delta in deltas if delta)
+        if total:
+            counts[review_id] = total
+    return counts
+
+
+def flush_helpful_votes():
+    """Apply pending deltas to ProductReview.helpful_count. Returns the number of reviews updated."""
+    # Overlapping beat runs would both apply the same FLUSHING_KEY
+    if not cache.add(FLUSH_LOCK_KEY, 1, FLUSH_LOCK_TIMEOUT):
+        return 0
+    try:
+        return _flush()
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def _flush():
+    redis = get_redis_connection('default')
+    if not redis.exists(FLUSHING_KEY):
+        if not redis.exists(PENDING_KEY):
+            return 0
+        # Votes arriving from now on go into a fresh hash
+        redis.rename(PENDING_KEY, FLUSHING_KEY)
+
+    deltas = {int(review_id): int(delta) for review_id, delta in redis.hgetall(FLUSHING_KEY).items()}
+    with transaction.atomic():
+        if deltas:
+            ProductReview.objects.filter(id__in=deltas).update(helpful_count=F('helpful_count') + Case(
+                *[When(id=review_id, then=Value(delta)) for review_id, delta in deltas.items()],
+                default=Value(0),
+                output_field=IntegerField(),
+            ))
+        # Dropped together with the commit; a rollback leaves the deltas for the next run
+        transaction.on_commit(lambda: redis.delete(FLUSHING_KEY))
+    return len(deltas)
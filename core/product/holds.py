@@ -0,0 +1,118 @@
+"""
+Soft stock holds for carts (enabled by STOCK_HOLDS_ENABLED).
+
+Putting a product in a cart holds that many units in Redis for STOCK_HOLD_TTL
+seconds, refreshed on every change of the line. A hold is only granted while
+the product's stock minus everybody else's holds covers it, so during a
+flash sale customers are turned away at add-to-cart time rather than at
+checkout. Checkout turns the holds into real decrements (product.stock) and
+drops them; release_expired_holds() sweeps the abandoned ones.
+
+Per product there is a sorted set of holders (carts) scored by expiry, a hash
+of their quantities and a running total, all changed together by Lua scripts
+so concurrent carts can't over-hold.
+"""
+
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+PRODUCTS_KEY = 'stock_hold_products'
+
+# Drops expired holders of one product and takes their units off the total
+_EXPIRE = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, holder in ipairs(expired) do
+    redis.call('DECRBY', KEYS[3], tonumber(redis.call('HGET', KEYS[2], holder) or '0'))
+    redis.call('HDEL', KEYS[2], holder)
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+end
+'''
+
+# Remove one holder; forgets the product once nobody holds it
+_RELEASE = '''
+local released = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or '0')
+redis.call('DECRBY', KEYS[3], released)
+redis.call('HDEL', KEYS[2], ARGV[2])
+redis.call('ZREM', KEYS[1], ARGV[2])
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+    redis.call('SREM', KEYS[4], ARGV[3])
+end
+'''
+
+# ARGV: now, holder, product id, quantity, stock, expires at
+# Returns {granted, units still free for others}
+HOLD_SCRIPT = _EXPIRE + '''
+local quantity = tonumber(ARGV[4])
+local own = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or '0')
+local free = tonumber(ARGV[5]) - (tonumber(redis.call('GET', KEYS[3]) or '0') - own)
+if quantity == 0 then
+''' + _RELEASE + '''
+    return {1, math.max(free, 0)}
+end
+-- Shrinking a hold is always allowed, even if stock dropped below the holds meanwhile
+if quantity > own and quantity > free then
+    return {0, math.max(free, 0)}
+end
+redis.call('HSET', KEYS[2], ARGV[2], quantity)
+redis.call('ZADD', KEYS[1], ARGV[6], ARGV[2])
+redis.call('INCRBY', KEYS[3], quantity - own)
+redis.call('SADD', KEYS[4], ARGV[3])
+return {1, math.max(free - quantity, 0)}
+'''
+
+# ARGV: now, holder, product id
+RELEASE_SCRIPT = _EXPIRE + _RELEASE + 'return 1'
+
+# ARGV: now, holder (unused), product id
+SWEEP_SCRIPT = _EXPIRE + '''
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+    redis.call('SREM', KEYS[4], ARGV[3])
+end
+return 1
+'''
+
+
+def _keys(product_id):
+    return [
+        f'stock_hold:{product_id}:expiry',
+        f'stock_hold:{product_id}:quantity',
+        f'stock_hold:{product_id}:total',
+        PRODUCTS_KEY,
+    ]
+
+
+def _run(script, product_id, holder='', *args):
+    redis = get_redis_connection('default')
+    return redis.eval(script, 4, *_keys(product_id), time.time(), holder, product_id, *args)
+
+
+def hold_stock(product_id, holder, quantity, stock):
+    """
+    Hold `quantity` units of a product for `holder` (a cart id), replacing its previous hold.
+
+    `stock` is the product's current stock_quantity. Returns (granted, units left for others);
+    a quantity of 0 releases the hold.
+    """
+    granted, free = _run(HOLD_SCRIPT, product_id, holder, quantity, stock, time.time() + settings.STOCK_HOLD_TTL)
+    return bool(granted), free
+
+
+def release_holds(holder, product_ids):
+    for product_id in product_ids:
+        _run(RELEASE_SCRIPT, product_id, holder)
+
+
+def release_expired_holds():
+    """Sweep expired holds of every held product. Returns the number of products checked."""
+    redis = get_redis_connection('default')
+    product_ids = [int(product_id) for product_id in redis.smembers(PRODUCTS_KEY)]
+    for product_id in product_ids:
+        _run(SWEEP_SCRIPT, product_id)
+    return len(product_ids)
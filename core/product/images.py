@@ -0,0 +1,232 @@
+"""
+Resized WebP/JPEG derivatives of uploaded images.
+
+Saving a model listed in IMAGE_FIELDS with a new upload queues
+product.tasks.generate_image_variants, which renders every preset in both
+formats with Pillow. Files are named after the SHA-256 of the source bytes
+(derivatives/ab/abcd.../480w.webp), so re-uploading the same picture reuses
+the existing files and a name can be cached forever. The resulting paths are
+stored on the row itself, in the variants field next to the image, so
+serializers need no extra queries to expose them.
+
+fetch_product_image() stores a picture given by URL (bulk imports) the same way.
+The URLs come from managers, so only http(s) hosts that resolve to public
+addresses are fetched, and every redirect hop is checked again. The connection
+goes to the address that was checked (PinnedAdapter), so a host that resolves
+differently a moment later (DNS rebinding) can't slip past the check.
+"""
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+from urllib.parse import urljoin, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+# Longest side in pixels; thumb is 2x the 64px list thumbnails
+PRESETS = {
+    'thumb': 128,
+    'card': 480,
+    'full': 1200,
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# Limits for images fetched from import URLs
+DOWNLOAD_TIMEOUT = 15
+DOWNLOAD_MAX_BYTES = 10 * 1024 * 1024
+DOWNLOAD_MAX_REDIRECTS = 3
+
+# Model label -> (image field, variants field)
+IMAGE_FIELDS = {
+    'product.Product': ('image', 'image_variants'),
+    'product.ProductImage': ('image', 'image_variants'),
+    'product.Category': ('image', 'image_variants'),
+    'product.Company': ('logo', 'logo_variants'),
+    'user.MyUser': ('avatar', 'avatar_variants'),
+}
+
+
+def _digest(field_file):
+    sha = hashlib.sha256()
+    field_file.open('rb')
+    try:
+        for chunk in field_file.chunks():
+            sha.update(chunk)
+    finally:
+        field_file.close()
+    return sha.hexdigest()
+
+
+def _encode(image, fmt, options):
+    if fmt == 'JPEG' and image.mode != 'RGB':
+        # JPEG has no alpha, flatten onto white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def build_variants(field_file):
+    """
+    Render every preset of `field_file` and return {'source': name, preset: {format: path}}.
+
+    Files that Pillow can't read (e.g. SVG logos) get no presets.
+    """
+    variants = {'source': field_file.name}
+    digest = _digest(field_file)
+    base = f'derivatives/{digest[:2]}/{digest}'
+
+    missing = [
+        (preset, size, ext) for preset, size in PRESETS.items() for ext in FORMATS
+        if not default_storage.exists(f'{base}/{size}w.{ext}')
+    ]
+    if missing:
+        field_file.open('rb')
+        try:
+            with Image.open(field_file) as source:
+                # Let the JPEG decoder downscale while reading, the largest preset is all we need
+                source.draft('RGB', (max(PRESETS.values()),) * 2)
+                source = ImageOps.exif_transpose(source)
+                if source.mode not in ('RGB', 'RGBA'):
+                    source = source.convert('RGBA' if 'transparency' in source.info else 'RGB')
+                for preset, size, ext in missing:
+                    image = source.copy()
+                    image.thumbnail((size, size), Image.LANCZOS)
+                    fmt, options = FORMATS[ext]
+                    default_storage.save(f'{base}/{size}w.{ext}', ContentFile(_encode(image, fmt, options)))
+        except UnidentifiedImageError:
+            return variants
+        finally:
+            field_file.close()
+
+    for preset, size in PRESETS.items():
+        variants[preset] = {ext: f'{base}/{size}w.{ext}' for ext in FORMATS}
+    return variants
+
+
+def variants_outdated(instance):
+    image_field, variants_field = IMAGE_FIELDS[instance._meta.label]
+    name = getattr(instance, image_field).name or ''
+    return (getattr(instance, variants_field) or {}).get('source', '') != name
+
+
+def refresh_variants(model_label, pk):
+    """Regenerate the variants of one row. Returns False if the row is gone or its image changed meanwhile."""
+    model = apps.get_model(model_label)
+    image_field, variants_field = IMAGE_FIELDS[model_label]
+    instance = model.objects.filter(pk=pk).only('pk', image_field).first()
+    if instance is None:
+        return False
+
+    field_file = getattr(instance, image_field)
+    variants = build_variants(field_file) if field_file else {}
+
+    with transaction.atomic():
+        current = model.objects.select_for_update().filter(pk=pk).values_list(image_field, flat=True).first()
+        # A newer upload has its own task queued
+        if (current or '') != (field_file.name or ''):
+            return False
+        model.objects.filter(pk=pk).update(**{variants_field: variants})
+    return True
+
+
+def check_public_url(url):
+    """Raise ValueError unless `url` is http(s) and its host resolves only to public addresses. Returns one of them."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError(f'{url} is not an http(s) URL')
+    addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port or None)}
+    for address in addresses:
+        # Drop the IPv6 zone, e.g. fe80::1%eth0
+        if not ipaddress.ip_address(address.split('%')[0]).is_global:
+            raise ValueError(f'{url} points to a non-public address {address}')
+    return min(addresses)
+
+
+class PinnedAdapter(HTTPAdapter):
+    """Connects to a fixed address; the URL's host is still sent as Host header, SNI and certificate name."""
+
+    def __init__(self, address):
+        self.address = address
+        super().__init__()
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        hostname = host_params['host']
+        host_params['host'] = self.address
+        if host_params['scheme'] == 'https':
+            pool_kwargs['server_hostname'] = hostname
+            pool_kwargs['assert_hostname'] = hostname
+        return host_params, pool_kwargs
+
+
+def _download(url):
+    with requests.Session() as session:
+        # A proxy would resolve the host again on its own
+        session.trust_env = False
+        for _ in range(DOWNLOAD_MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            session.mount(f'{parsed.scheme}://', PinnedAdapter(check_public_url(url)))
+            response = session.get(
+                url, headers={'Host': parsed.netloc.rpartition('@')[2]},
+                timeout=DOWNLOAD_TIMEOUT, stream=True, allow_redirects=False,
+            )
+            if not response.is_redirect:
+                break
+            url = urljoin(url, response.headers['Location'])
+            response.close()
+        else:
+            raise ValueError(f'Too many redirects for {url}')
+
+        with response:
+            response.raise_for_status()
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > DOWNLOAD_MAX_BYTES:
+                    raise ValueError(f'{url} is larger than {DOWNLOAD_MAX_BYTES} bytes')
+    return bytes(content)
+
+
+def fetch_product_image(product_id, url):
+    """Fetch `url` into the product's image. Returns False if the product is gone or already has it."""
+    Product = apps.get_model('product', 'Product')
+    product = Product.objects.filter(pk=product_id).first()
+    if product is None or product.image_source_url == url:
+        return False
+
+    content = _download(url)
+    name = os.path.basename(urlparse(url).path) or 'image'
+    product.image.save(name, ContentFile(content), save=False)
+    product.image_source_url = url
+    # Goes through post_save, so caches are purged and variants queued as for any upload
+    product.save(update_fields=['image', 'image_source_url', 'updated_at'])
+    return True
+
+
+def variant_urls(variants, request=None):
+    """Map stored variants to {preset: {format: url}}, absolute when a request is given."""
+    urls = {}
+    for preset in PRESETS:
+        paths = (variants or {}).get(preset)
+        if not paths:
+            continue
+        urls[preset] = {}
+        for ext, path in paths.items():
+            url = default_storage.url(path)
+            urls[preset][ext] = request.build_absolute_uri(url) if request else url
+    return urls
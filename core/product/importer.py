@@ -0,0 +1,253 @@
+"""
+Streaming bulk import of a company's menu from CSV or JSONL.
+
+Rows are read one at a time and validated and written in batches of
+BATCH_SIZE, so memory stays flat however large the file is. Each batch is one
+transaction: an INSERT ... ON CONFLICT (company, sku) DO UPDATE per set of
+columns the rows give, then set-based tag, search index and cache
+maintenance. Images given as `image_url` are downloaded later by Celery, and
+only when the URL changed since the last import.
+
+Categories are resolved from a map loaded once, by name or by slash-separated
+path from the root ("Food/Burgers"). Only the company's own and the shared
+categories count, its own shadowing shared ones of the same name; a name that
+still matches several categories is an error rather than a guess.
+
+Rows that fail validation are reported with their line number and skipped;
+only the first MAX_REPORTED_ERRORS are kept in the report.
+"""
+
+import csv
+import io
+import json
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Q
+from rest_framework import serializers
+
+from .catalog import bump_catalog_version, invalidate_product_details
+from .models import Category, Product, Tag, parse_tags
+from .search import get_search_backend
+from .stock import reset_bucket_stock
+from .tasks import download_product_image
+
+
+FORMATS = ('csv', 'jsonl')
+BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+# Written on conflict when the row gives the column; the rest keep their values
+UPDATABLE_FIELDS = [
+    'name', 'description', 'original_price', 'discounted_price', 'category', 'ingredients', 'grams',
+    'stock_quantity', 'is_available', 'tags', 'search_keywords',
+]
+
+# Stands in the category map for a name several categories share
+AMBIGUOUS = object()
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    sku = serializers.CharField(max_length=64)
+    name = serializers.CharField(max_length=255)
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+    original_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    discounted_price = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=0, required=False, allow_null=True, default=None,
+    )
+    category = serializers.CharField(max_length=255)
+    ingredients = serializers.CharField(required=False, allow_blank=True, allow_null=True, default=None)
+    grams = serializers.IntegerField(min_value=0, max_value=32767, required=False, default=0)
+    stock_quantity = serializers.IntegerField(min_value=0, required=False, default=0)
+    is_available = serializers.BooleanField(required=False, default=True)
+    tags = serializers.CharField(max_length=500, required=False, allow_blank=True, allow_null=True, default=None)
+    search_keywords = serializers.CharField(
+        max_length=500, required=False, allow_blank=True, allow_null=True, default=None,
+    )
+    image_url = serializers.URLField(max_length=500, required=False, allow_blank=True, default='')
+
+    def validate_category(self, value):
+        category_id = self.context['categories'].get(category_key(value))
+        if category_id is None:
+            raise serializers.ValidationError(f'Unknown category "{value}".')
+        if category_id is AMBIGUOUS:
+            raise serializers.ValidationError(
+                f'Several categories are named "{value}", give its path instead, e.g. "Parent/{value.strip()}".'
+            )
+        return category_id
+
+
+def category_key(value):
+    return '/'.join(part.strip().lower() for part in value.split('/'))
+
+
+def load_categories(company):
+    """Map the names and paths of the categories `company` can import into to their ids."""
+    rows = list(
+        Category.objects.filter(Q(company=company) | Q(company__isnull=True))
+        .values_list('id', 'name', 'path', 'company_id')
+    )
+    names = {pk: name for pk, name, _, _ in rows}
+    categories = {}
+    # Shared categories first, so the company's own replace them
+    for own in (False, True):
+        tier = {}
+        for pk, name, path, company_id in rows:
+            if (company_id is not None) != own:
+                continue
+            ancestors = [names[int(part)] for part in path.split('/')[:-2] if int(part) in names]
+            for key in {category_key(name), category_key('/'.join([*ancestors, name]))}:
+                tier[key] = pk if tier.get(key, pk) == pk else AMBIGUOUS
+        categories.update(tier)
+    return categories
+
+
+def _clean_csv_row(row):
+    # Empty cells mean "not given", so optional fields fall back to their defaults
+    return {key: value for key, value in row.items() if key and value not in ('', None)}
+
+
+def read_rows(stream, file_format):
+    """Yield (line number, raw row) from a binary stream of CSV or JSONL."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, _clean_csv_row(row)
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+
+
+def _queue_downloads(downloads):
+    for product_id, url in downloads:
+        download_product_image.delay(product_id, url)
+
+
+class ProductImporter:
+    def __init__(self, company):
+        self.company = company
+        self.categories = load_categories(company)
+        self.report = {'created': 0, 'updated': 0, 'error_count': 0, 'errors': []}
+
+    def add_error(self, line_number, errors):
+        self.report['error_count'] += 1
+        if len(self.report['errors']) < MAX_REPORTED_ERRORS:
+            self.report['errors'].append({'line': line_number, 'errors': errors})
+
+    def run(self, rows):
+        rows = iter(rows)
+        while batch := list(islice(rows, BATCH_SIZE)):
+            self.import_batch(batch)
+        return self.report
+
+    def import_batch(self, batch):
+        valid = {}
+        for line_number, row in batch:
+            if row is None:
+                self.add_error(line_number, {'non_field_errors': ['Not a JSON object.']})
+                continue
+            serializer = ProductImportRowSerializer(data=row, context={'categories': self.categories})
+            if serializer.is_valid():
+                # A repeated sku within the batch: the last row wins
+                valid[serializer.validated_data['sku']] = (serializer.validated_data, row.keys())
+            else:
+                self.add_error(line_number, {
+                    field: [str(message) for message in messages] for field, messages in serializer.errors.items()
+                })
+        if not valid:
+            return
+
+        # Rows are upserted in groups sharing the same columns, so a column a row leaves out keeps its value
+        groups = {}
+        for sku, (data, keys) in valid.items():
+            fields = tuple(field for field in UPDATABLE_FIELDS if field in keys)
+            groups.setdefault(fields, []).append(data)
+
+        with transaction.atomic():
+            existing = {
+                sku: (pk, source_url) for sku, pk, source_url in Product.objects
+                .filter(company=self.company, sku__in=valid)
+                .values_list('sku', 'id', 'image_source_url')
+            }
+            for fields, rows in groups.items():
+                Product.objects.bulk_create(
+                    [self.build_product(data) for data in rows],
+                    update_conflicts=True,
+                    unique_fields=['company', 'sku'],
+                    update_fields=[*fields, 'updated_at'],
+                )
+            new_ids = dict(
+                Product.objects.filter(company=self.company, sku__in=valid.keys() - existing.keys())
+                .values_list('sku', 'id')
+            )
+            ids = {sku: existing[sku][0] if sku in existing else new_ids[sku] for sku in valid}
+
+            restocked = {
+                existing[sku][0]: data['stock_quantity']
+                for sku, (data, keys) in valid.items() if sku in existing and 'stock_quantity' in keys
+            }
+            if restocked:
+                reset_bucket_stock(restocked)
+            tagged = {ids[sku]: data['tags'] for sku, (data, keys) in valid.items() if 'tags' in keys}
+            if tagged:
+                self.sync_tags(tagged)
+            get_search_backend().index_products(ids.values())
+
+            downloads = [
+                (ids[sku], data['image_url']) for sku, (data, _) in valid.items()
+                if data['image_url'] and data['image_url'] != existing.get(sku, (None, ''))[1]
+            ]
+            updated_ids = [pk for pk, _ in existing.values()]
+            transaction.on_commit(lambda: invalidate_product_details(updated_ids))
+            transaction.on_commit(bump_catalog_version)
+            if downloads:
+                transaction.on_commit(lambda: _queue_downloads(downloads))
+
+        self.report['created'] += len(new_ids)
+        self.report['updated'] += len(existing)
+
+    def build_product(self, data):
+        return Product(
+            company=self.company,
+            sku=data['sku'],
+            name=data['name'],
+            description=data['description'],
+            original_price=data['original_price'],
+            discounted_price=data['discounted_price'],
+            category_id=data['category'],
+            ingredients=data['ingredients'],
+            grams=data['grams'],
+            stock_quantity=data['stock_quantity'],
+            is_available=data['is_available'],
+            tags=data['tags'],
+            search_keywords=data['search_keywords'],
+        )
+
+    def sync_tags(self, tags_by_product):
+        """Batch version of Product.sync_tags."""
+        names_by_product = {product_id: parse_tags(tags) for product_id, tags in tags_by_product.items()}
+        all_names = {name for names in names_by_product.values() for name in names}
+        Tag.objects.bulk_create([Tag(name=name) for name in all_names], ignore_conflicts=True)
+        tag_ids = dict(Tag.objects.filter(name__in=all_names).values_list('name', 'id'))
+
+        Through = Product.tag_set.through
+        Through.objects.filter(product_id__in=names_by_product).delete()
+        Through.objects.bulk_create([
+            Through(product_id=product_id, tag_id=tag_ids[name])
+            for product_id, names in names_by_product.items()
+            for name in names
+        ])
+
+
+def import_products(stream, file_format, company):
+    """Import a CSV or JSONL binary stream into `company`'s products and return the report."""
+    if file_format not in FORMATS:
+        raise ValueError(f'Unsupported format "{file_format}", use csv or jsonl.')
+    return ProductImporter(company).run(read_rows(stream, file_format))
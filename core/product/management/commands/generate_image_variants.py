@@ -0,0 +1,21 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from product.images import IMAGE_FIELDS, variants_outdated
+from product.tasks import generate_image_variants
+
+
+class Command(BaseCommand):
+    help = 'Queue resized variants for every image that does not have up-to-date ones'
+
+    def handle(self, *args, **options):
+        for label, (image_field, variants_field) in IMAGE_FIELDS.items():
+            model = apps.get_model(label)
+            queued = 0
+            rows = model.objects.only('pk', image_field, variants_field).iterator(chunk_size=2000)
+            for instance in rows:
+                if variants_outdated(instance):
+                    generate_image_variants.delay(label, instance.pk)
+                    queued += 1
+            self.stdout.write(f'{label}: queued {queued}')
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,37 @@
+import csv
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from product.importer import import_products
+from product.models import Company
+
+
+class Command(BaseCommand):
+    help = 'Create or update a company\'s products from a CSV or JSONL file, matched by sku'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--company', type=int, required=True, help='Company ID')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension')
+
+    def handle(self, *args, **options):
+        try:
+            company = Company.objects.get(pk=options['company'])
+        except Company.DoesNotExist:
+            raise CommandError(f'Company {options["company"]} does not exist')
+        file_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+
+        try:
+            with open(options['path'], 'rb') as stream:
+                report = import_products(stream, file_format, company)
+        except (OSError, ValueError, csv.Error) as e:
+            raise CommandError(str(e))
+
+        for error in report['errors']:
+            self.stdout.write(self.style.ERROR(f'line {error["line"]}: {error["errors"]}'))
+        if report['error_count'] > len(report['errors']):
+            self.stdout.write(self.style.ERROR(f'... {report["error_count"] - len(report["errors"])} more errors'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {report["created"]}, updated {report["updated"]}, skipped {report["error_count"]} rows'
+        ))
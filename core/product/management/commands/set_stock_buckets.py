@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from product.models import Product
+from product.stock import set_stock_buckets
+
+
+class Command(BaseCommand):
+    help = 'Switch a hot product to sharded stock buckets, or back with --buckets 0'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product', type=int, help='Product ID')
+        parser.add_argument('--buckets', type=int, default=8, help='Number of stock buckets, 0 turns sharding off')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['buckets'] <= 64:
+            raise CommandError('--buckets must be between 0 and 64')
+        try:
+            total = set_stock_buckets(options['product'], options['buckets'])
+        except Product.DoesNotExist:
+            raise CommandError(f'Product {options["product"]} does not exist')
+        self.stdout.write(self.style.SUCCESS(
+            f'Product {options["product"]}: {total} in stock over {options["buckets"]} buckets'
+        ))
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-17 15:58
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # GIN indexes and tsvectors only exist on PostgreSQL; other databases
+    # use the in-process index from product.search
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_search_vector_idx '
+        'ON product_product USING gin (search_vector)'
+    )
+    config = settings.PRODUCT_SEARCH_CONFIG
+    Product = apps.get_model('product', 'Product')
+    Product.objects.update(search_vector=(
+        SearchVector('name', weight='A', config=config)
+        + SearchVector('tags', 'search_keywords', weight='B', config=config)
+        + SearchVector('description', weight='C', config=config)
+    ))
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS product_search_vector_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0017_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
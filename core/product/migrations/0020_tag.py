@@ -0,0 +1,50 @@
+# Generated by Django 5.2.5 on 2026-10-17 16:01
+
+from django.db import migrations, models
+
+
+def split_product_tags(apps, schema_editor):
+    # Same normalization as product.models.parse_tags, frozen here for the migration
+    Tag = apps.get_model('product', 'Tag')
+    Product = apps.get_model('product', 'Product')
+    Through = Product.tag_set.through
+
+    products = Product.objects.exclude(tags__isnull=True).exclude(tags='').values_list('id', 'tags')
+    for chunk_start in range(0, products.count(), 1000):
+        chunk = list(products.order_by('id')[chunk_start:chunk_start + 1000])
+        names_by_product = {}
+        for product_id, tags in chunk:
+            names = (' '.join(part.lower().split())[:100] for part in tags.split(','))
+            names_by_product[product_id] = list(dict.fromkeys(name for name in names if name))
+
+        all_names = {name for names in names_by_product.values() for name in names}
+        Tag.objects.bulk_create([Tag(name=name) for name in all_names], ignore_conflicts=True)
+        tag_ids = dict(Tag.objects.filter(name__in=all_names).values_list('name', 'id'))
+        Through.objects.bulk_create([
+            Through(product_id=product_id, tag_id=tag_ids[name])
+            for product_id, names in names_by_product.items()
+            for name in names
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0019_product_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='tag_set',
+            field=models.ManyToManyField(blank=True, related_name='products', to='product.tag'),
+        ),
+        migrations.RunPython(split_product_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.5 on 2026-10-17 16:04
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_review_aggregates(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    Company = apps.get_model('product', 'Company')
+    ProductReview = apps.get_model('product', 'ProductReview')
+
+    def backfill(model, group_by):
+        rows = ProductReview.objects.exclude(**{f'{group_by}__isnull': True}).values(group_by).annotate(
+            total=Sum('rating'), count=Count('id')
+        ).order_by()
+        objects = []
+        for row in rows:
+            objects.append(model(
+                pk=row[group_by], rating_sum=row['total'], rating_count=row['count'],
+                rating=(Decimal(row['total']) / row['count']).quantize(Decimal('0.01')),
+            ))
+        model.objects.bulk_update(objects, ['rating_sum', 'rating_count', 'rating'], batch_size=1000)
+
+    backfill(Product, 'product_id')
+    backfill(Company, 'product__company_id')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0020_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='company',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_review_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.5 on 2026-10-17 16:06
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_rating_histogram(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    ProductReview = apps.get_model('product', 'ProductReview')
+
+    histograms = {}
+    rows = ProductReview.objects.values_list('product_id', 'rating').annotate(count=Count('id')).order_by()
+    for product_id, rating, count in rows:
+        histograms.setdefault(product_id, {})[f'rating_{rating}'] = count
+
+    fields = [f'rating_{stars}' for stars in range(1, 6)]
+    Product.objects.bulk_update(
+        [Product(pk=product_id, **{field: counts.get(field, 0) for field in fields})
+         for product_id, counts in histograms.items()],
+        fields, batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0021_review_aggregates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', 'created_at', 'id'], name='review_product_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', 'helpful_count', 'id'], name='review_product_helpful_idx'),
+        ),
+        migrations.RunPython(backfill_rating_histogram, migrations.RunPython.noop),
+    ]
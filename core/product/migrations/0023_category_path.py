@@ -0,0 +1,51 @@
+# Generated by Django 5.2.5 on 2026-10-17 16:07
+
+from django.db import migrations, models
+
+
+def build_category_paths(apps, schema_editor):
+    Category = apps.get_model('product', 'Category')
+    parents = dict(Category.objects.values_list('id', 'parent_category_id'))
+
+    paths = {}
+
+    def path_of(category_id):
+        # Walk up iteratively; the adjacency list may be deep
+        chain = []
+        while category_id is not None and category_id not in paths:
+            chain.append(category_id)
+            category_id = parents[category_id]
+            if category_id in chain:
+                raise ValueError(f'Category {category_id} is its own ancestor')
+        prefix = paths.get(category_id, '')
+        for node in reversed(chain):
+            prefix = paths[node] = f'{prefix}{node:010d}/'
+        return prefix
+
+    for category_id in parents:
+        path_of(category_id)
+    Category.objects.bulk_update(
+        [Category(pk=pk, path=path, depth=path.count('/') - 1) for pk, path in paths.items()],
+        ['path', 'depth'], batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0022_review_histogram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_category_paths, migrations.RunPython.noop),
+    ]
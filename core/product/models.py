@@ -1,5 +1,9 @@
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Substr
 
 
 user = get_user_model()
@@ -23,11 +27,17 @@ class SVGAndImageField(ImageField):
 class Company(models.Model):
     name = models.CharField(max_length=255)
     logo = models.FileField(upload_to='companies/', null=True, blank=True)
+    # Resized copies, see product/images.py
+    logo_variants = models.JSONField(default=dict, blank=True, editable=False)
     address = models.TextField(null=True, blank=True)
     phone_number = models.CharField(max_length=123 ,null=True, blank=True)
     rating = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
     description = models.TextField(null=True, blank=True)
 
+    # Running review aggregates over all products, maintained by product.reviews
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+
     def __str__(self):
         return self.name
 
@@ -35,23 +45,102 @@ class Company(models.Model):
 class Category(models.Model):
     name = models.CharField(max_length=255)
     image = SVGAndImageField(upload_to='categories/', null=True, blank=True)
+    # Resized copies, see product/images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     company = models.ForeignKey(Company, on_delete=models.CASCADE, blank=True, null=True, related_name='categories')
     parent_category = models.ForeignKey('self', on_delete=models.CASCADE, blank=True, null=True, related_name='subcategories')
     description = models.TextField(null=True, blank=True)
 
+    # Materialized path: zero-padded ids from the root down, e.g. "0000000001/0000000007/".
+    # A subtree is every category whose path starts with the root's path.
+    path = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+
     def __str__(self):
         return self.name
 
+    def clean(self):
+        if self.pk and self.parent_category_id:
+            parent_path = Category.objects.filter(pk=self.parent_category_id).values_list('path', flat=True).first()
+            if parent_path and self.path and parent_path.startswith(self.path):
+                raise ValidationError({'parent_category': 'A category cannot be moved under itself.'})
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'parent_category' not in update_fields:
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            # The stored path, under lock: another instance may have moved this subtree meanwhile.
+            # Saved back as it is, so the subtree update below still finds the row by its prefix
+            old_path = ''
+            if self.pk:
+                stored = Category.objects.select_for_update().filter(pk=self.pk).values_list('path', 'depth').first()
+                if stored:
+                    old_path, self.depth = stored
+            self.path = old_path
+
+            parent_path = ''
+            if self.parent_category_id:
+                # Read from the database, the cached parent instance may hold a stale path
+                parent_path = Category.objects.filter(pk=self.parent_category_id).values_list('path', flat=True).get()
+                if old_path and parent_path.startswith(old_path):
+                    raise ValueError('A category cannot be moved under itself.')
+
+            super().save(*args, **kwargs)
+
+            self.path = f'{parent_path}{self.pk:010d}/'
+            self.depth = self.path.count('/') - 1
+            if self.path == old_path:
+                return
+            if not old_path:
+                Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+                return
+            # Move the whole subtree (this category included) in one statement
+            Category.objects.filter(path__startswith=old_path).update(
+                path=Concat(Value(self.path), Substr('path', len(old_path) + 1)),
+                depth=F('depth') + (self.path.count('/') - old_path.count('/')),
+            )
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=100, unique=True)  # normalized, see parse_tags
+
+    def __str__(self):
+        return self.name
+
+
+def parse_tags(text):
+    """Split a comma-separated tag string into normalized, de-duplicated tag names."""
+    if not text:
+        return []
+    names = (' '.join(part.lower().split())[:100] for part in text.split(','))
+    return list(dict.fromkeys(name for name in names if name))
+
 
 class Product(models.Model):
     name = models.CharField(max_length=255)
+    # Company's own item code, the key bulk imports upsert on (see product/importer.py)
+    sku = models.CharField(max_length=64, null=True, blank=True)
     description = models.TextField()
     image = models.FileField(upload_to='products/', blank=True, null=True)
+    # Resized copies, see product/images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # URL the image was last downloaded from by an import, so re-imports don't fetch it again
+    image_source_url = models.URLField(max_length=500, blank=True, default='', editable=False)
     original_price = models.DecimalField(max_digits=10, decimal_places=2)
     discounted_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     ingredients = models.TextField(null=True, blank=True)
     rating = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)  # maintained by product.reviews
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    # Star histogram, maintained by product.reviews alongside the sum and count
+    rating_1 = models.PositiveIntegerField(default=0, editable=False)
+    rating_2 = models.PositiveIntegerField(default=0, editable=False)
+    rating_3 = models.PositiveIntegerField(default=0, editable=False)
+    rating_4 = models.PositiveIntegerField(default=0, editable=False)
+    rating_5 = models.PositiveIntegerField(default=0, editable=False)
     company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='products', null=True, blank=True)
     grams = models.PositiveSmallIntegerField(default=0)
     
@@ -59,15 +148,31 @@ class Product(models.Model):
     stock_quantity = models.PositiveIntegerField(default=0)
     low_stock_threshold = models.PositiveIntegerField(default=10)
     is_available = models.BooleanField(default=True)
+    # High-contention mode: the stock lives in this many StockBucket rows, 0 = off (see product/stock.py)
+    stock_buckets = models.PositiveSmallIntegerField(default=0, editable=False)
     preparation_time = models.PositiveIntegerField(default=15)  # in minutes
     
     # SEO and search
-    tags = models.CharField(max_length=500, blank=True, null=True)  # comma-separated tags
+    tags = models.CharField(max_length=500, blank=True, null=True)  # comma-separated tags, mirrored into tag_set
+    tag_set = models.ManyToManyField(Tag, related_name='products', blank=True)
     search_keywords = models.CharField(max_length=500, blank=True, null=True)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)  # maintained by product.search
     
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
 
+    class Meta:
+        # (field, id) pairs back the keyset pagination in ProductSearchView
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='product_created_id_idx'),
+            models.Index(fields=['original_price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['rating', 'id'], name='product_rating_id_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'sku'], name='product_company_sku_uniq'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -82,23 +187,66 @@ class Product(models.Model):
     @property
     def is_out_of_stock(self):
         return self.stock_quantity == 0
+
+    @property
+    def rating_histogram(self):
+        return {str(stars): getattr(self, f'rating_{stars}') for stars in range(1, 6)}
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Lets save() tell a restock from an untouched copy of stock_quantity
+        instance._loaded_stock_quantity = instance.__dict__.get('stock_quantity')
+        return instance
+
+    def refresh_from_db(self, *args, fields=None, **kwargs):
+        super().refresh_from_db(*args, fields=fields, **kwargs)
+        if fields is None or 'stock_quantity' in fields:
+            self._loaded_stock_quantity = self.__dict__.get('stock_quantity')
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        restocked = (
+            not self._state.adding
+            and (update_fields is None or 'stock_quantity' in update_fields)
+            and self.stock_quantity != getattr(self, '_loaded_stock_quantity', self.stock_quantity)
+        )
+        if not restocked:
+            return super().save(*args, **kwargs)
+
+        from .stock import reset_bucket_stock
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Sharded products keep their stock in buckets, the next rebalance would undo the change
+            reset_bucket_stock({self.pk: self.stock_quantity})
+        self._loaded_stock_quantity = self.stock_quantity
+
+    def sync_tags(self):
+        """Mirror the comma-separated `tags` string into `tag_set`."""
+        names = parse_tags(self.tags)
+        if names:
+            Tag.objects.bulk_create([Tag(name=name) for name in names], ignore_conflicts=True)
+        self.tag_set.set(Tag.objects.filter(name__in=names))
+
     def reduce_stock(self, quantity):
         """Reduce stock quantity and check availability"""
-        if self.stock_quantity >= quantity:
-            self.stock_quantity -= quantity
-            if self.stock_quantity == 0:
-                self.is_available = False
-            self.save(update_fields=['stock_quantity', 'is_available'])
-            return True
-        return False
+        from .stock import InsufficientStock, reserve_stock
+
+        try:
+            with transaction.atomic():
+                reserve_stock({self.pk: quantity})
+        except InsufficientStock:
+            return False
+        self.refresh_from_db(fields=['stock_quantity', 'is_available'])
+        return True
     
     def add_stock(self, quantity):
         """Add stock quantity"""
-        self.stock_quantity += quantity
-        if not self.is_available and self.stock_quantity > 0:
-            self.is_available = True
-        self.save(update_fields=['stock_quantity', 'is_available'])
+        from .stock import release_stock
+
+        release_stock({self.pk: quantity})
+        self.refresh_from_db(fields=['stock_quantity', 'is_available'])
 
 
 class ProductReview(models.Model):
@@ -123,6 +271,11 @@ class ProductReview(models.Model):
     class Meta:
         unique_together = ['product', 'user']  # One review per user per product
         ordering = ['-created_at']
+        # Keyset pagination of a product's reviews
+        indexes = [
+            models.Index(fields=['product', 'created_at', 'id'], name='review_product_created_idx'),
+            models.Index(fields=['product', 'helpful_count', 'id'], name='review_product_helpful_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.product.name} ({self.rating} stars)"
@@ -131,6 +284,8 @@ class ProductReview(models.Model):
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.FileField(upload_to='products/images/')
+    # Resized copies, see product/images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     alt_text = models.CharField(max_length=255, blank=True)
     is_primary = models.BooleanField(default=False)
     order = models.PositiveIntegerField(default=0)
@@ -141,3 +296,18 @@ class ProductImage(models.Model):
     
     def __str__(self):
         return f"{self.product.name} - Image {self.id}"
+
+
+class StockBucket(models.Model):
+    """A slice of a hot product's stock, so reservations don't all lock the product row"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='buckets')
+    index = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'index'], name='stockbucket_product_index_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} - bucket {self.index}: {self.quantity}"
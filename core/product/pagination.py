@@ -0,0 +1,202 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are addressed by the (ordering value, id) pair of the last row instead of
+an offset, so every page is a single indexed range scan: no COUNT(*) and no
+OFFSET, and page 5000 costs the same as page 1.
+"""
+
+import base64
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CursorValueEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder drops microseconds, which would skip rows on a datetime cursor
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 20
+    max_page_size = 100
+    ordering = '-created_at'
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.get_ordering(request, queryset, view)
+        self.model_field = self.get_model_field(queryset.model, self.field)
+        self.nullable = self.model_field is not None and self.model_field.null
+
+        queryset = queryset.order_by(*self.get_order_by())
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.get_position_filter(*cursor))
+
+        # Fetch one extra row to learn whether there is a next page
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Take the primary ordering field from the view's OrderingFilter, the same
+        way DRF's CursorPagination does; the id tiebreaker is always appended.
+        """
+        ordering = None
+        for backend in getattr(view, 'filter_backends', []):
+            if issubclass(backend, OrderingFilter):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+        if not ordering:
+            ordering = getattr(view, 'ordering', None) or self.ordering
+
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        field = ordering[0]
+        return field.lstrip('-'), field.startswith('-')
+
+    def get_model_field(self, model, field):
+        try:
+            return model._meta.get_field(field)
+        except FieldDoesNotExist:
+            # Annotations such as search rank, which are never null
+            return None
+
+    def get_order_by(self):
+        # Nulls sort as the largest value (PostgreSQL's default), which keeps a
+        # plain (field, id) b-tree index usable in both directions
+        if self.descending:
+            return [F(self.field).desc(nulls_first=self.nullable or None), '-id']
+        return [F(self.field).asc(nulls_last=self.nullable or None), 'id']
+
+    def get_position_filter(self, value, pk):
+        after = 'lt' if self.descending else 'gt'
+        position = Q(**{f'{self.field}__{after}': value}) | Q(**{self.field: value, f'id__{after}': pk})
+        if not self.nullable:
+            return position
+
+        is_null = Q(**{f'{self.field}__isnull': True})
+        if self.descending:
+            if value is None:
+                # Still inside the leading block of nulls
+                return (is_null & Q(id__lt=pk)) | ~is_null
+            return position
+        if value is None:
+            # Already inside the trailing block of nulls
+            return is_null & Q(id__gt=pk)
+        return position | is_null
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        cursor = self.encode_cursor(getattr(last, self.field), last.pk)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def encode_cursor(self, value, pk):
+        payload = json.dumps([self.field, value, pk], cls=CursorValueEncoder)
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            field, value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        # Outside bigint the comparison itself fails in the database
+        if field != self.field or not -2 ** 63 <= pk < 2 ** 63:
+            # Ordering changed since the cursor was issued
+            raise NotFound(self.invalid_cursor_message)
+        return self.clean_cursor_value(value), pk
+
+    def clean_cursor_value(self, value):
+        """Coerce a decoded value to the ordering field's type, so a forged cursor is a 404 rather than a 500."""
+        if value is None:
+            if not self.nullable:
+                raise NotFound(self.invalid_cursor_message)
+            return None
+        try:
+            if self.model_field is None:
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError(value)
+                return value
+            return self.model_field.to_python(value)
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_schema_fields(self, view):
+        return []
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Курсор следующей страницы',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Количество результатов на странице',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class ProductCursorPagination(KeysetPagination):
+    page_size = 20
+    max_page_size = 100
+
+
+class ReviewCursorPagination(KeysetPagination):
+    page_size = 10
+    max_page_size = 50
@@ -0,0 +1,61 @@
+"""
+Incrementally maintained review aggregates.
+
+Product and Company keep a running rating sum and count, and Product a 1-5
+star histogram. Every review write shifts them with F() expressions and
+recomputes `rating` inside the same UPDATE, so listing or sorting by rating
+never runs AVG() over the reviews table. Call these helpers inside the
+transaction that writes the review; deletes are handled by a post_delete
+receiver in product.signals, whatever deleted the review.
+
+The product's cached detail is purged right away. The listings only see the
+new ratings on the next refresh_ratings() run (product.catalog), so a busy
+review stream doesn't keep the whole catalog cache cold.
+"""
+
+from django.db import transaction
+from django.db.models import DecimalField, F
+from django.db.models.functions import Cast, NullIf
+
+from .catalog import invalidate_product_details, mark_ratings_changed
+from .models import Company, Product
+
+
+PRODUCT_HISTOGRAM_FIELDS = [f'rating_{stars}' for stars in range(1, 6)]
+
+
+def _aggregate_update(sum_delta, count_delta):
+    # The right-hand side sees the old row, so the deltas are applied inside the average too
+    new_sum = F('rating_sum') + sum_delta
+    new_count = F('rating_count') + count_delta
+    return {
+        'rating_sum': new_sum,
+        'rating_count': new_count,
+        'rating': Cast(new_sum * 1.0 / NullIf(new_count, 0), DecimalField(max_digits=5, decimal_places=2)),
+    }
+
+
+def apply_rating_change(product, added=None, removed=None):
+    """
+    Shift the aggregates of `product` and its company by one review write.
+
+    `added` is the rating being written and `removed` the rating being replaced
+    or deleted: create passes only `added`, delete only `removed`, update both.
+    """
+    sum_delta = (added or 0) - (removed or 0)
+    count_delta = (added is not None) - (removed is not None)
+
+    product_update = _aggregate_update(sum_delta, count_delta)
+    if added is not None:
+        product_update[f'rating_{added}'] = F(f'rating_{added}') + 1
+    if removed is not None:
+        bucket = f'rating_{removed}'
+        product_update[bucket] = product_update.get(bucket, F(bucket)) - 1
+
+    Product.objects.filter(pk=product.pk).update(**product_update)
+    if product.company_id:
+        Company.objects.filter(pk=product.company_id).update(**_aggregate_update(sum_delta, count_delta))
+
+    # Queryset updates skip post_save, so invalidate the detail and flag the listings here
+    transaction.on_commit(mark_ratings_changed)
+    transaction.on_commit(lambda: invalidate_product_details([product.pk]))
@@ -0,0 +1,254 @@
+"""
+Relevance-ranked product search.
+
+On PostgreSQL products carry a stored, weighted tsvector (name > tags and
+search keywords > description) backed by a GIN index, and pg_trgm GIN indexes
+on name, tags and search keywords for typo-tolerant (fuzzy) search. Other
+databases (SQLite in dev/test) use an in-process inverted index and trigram
+index with the same weights, so the search API behaves the same offline.
+"""
+
+import re
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .catalog import get_catalog_version
+from .models import Product
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Same ordering as PostgreSQL's default ts_rank weights for A, B and C
+FIELD_WEIGHTS = (
+    ('name', 1.0),
+    ('tags', 0.4),
+    ('search_keywords', 0.4),
+    ('description', 0.2),
+)
+
+
+# Fields fuzzy search matches against, with their relative weights
+FUZZY_FIELD_WEIGHTS = (
+    ('name', 1.0),
+    ('tags', 0.4),
+    ('search_keywords', 0.4),
+)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def trigrams(word):
+    """Trigrams of a single word, padded the way pg_trgm does it."""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_similarity(a, b):
+    a, b = trigrams(a), trigrams(b)
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def did_you_mean(term, texts):
+    """
+    Correct each word of `term` to the closest word found in `texts` (the best
+    fuzzy matches). Returns None when nothing would change.
+    """
+    vocabulary = {token for text in texts for token in tokenize(text)}
+    if not vocabulary:
+        return None
+
+    corrected = []
+    for token in tokenize(term):
+        best = max(vocabulary, key=lambda word: (trigram_similarity(token, word), -abs(len(word) - len(token))))
+        corrected.append(best if trigram_similarity(token, best) >= settings.PRODUCT_FUZZY_THRESHOLD else token)
+
+    suggestion = ' '.join(corrected)
+    return suggestion if suggestion != ' '.join(tokenize(term)) else None
+
+
+def product_search_vector():
+    config = settings.PRODUCT_SEARCH_CONFIG
+    return (
+        SearchVector('name', weight='A', config=config)
+        + SearchVector('tags', 'search_keywords', weight='B', config=config)
+        + SearchVector('description', weight='C', config=config)
+    )
+
+
+class PostgresSearchBackend:
+    def search(self, queryset, term):
+        query = SearchQuery(term, config=settings.PRODUCT_SEARCH_CONFIG, search_type='websearch')
+        return queryset.filter(search_vector=query).annotate(
+            rank=SearchRank(F('search_vector'), query)
+        )
+
+    def fuzzy_search(self, queryset, term):
+        # The %> operator is what the gin_trgm_ops indexes serve; its cut-off is a setting
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('pg_trgm.word_similarity_threshold', %s, false)",
+                [str(settings.PRODUCT_FUZZY_THRESHOLD)],
+            )
+
+        matches = Q()
+        for field, _ in FUZZY_FIELD_WEIGHTS:
+            matches |= Q(**{f'{field}__trigram_word_similar': term})
+        return queryset.filter(matches).annotate(rank=Greatest(*[
+            TrigramWordSimilarity(term, field) * weight for field, weight in FUZZY_FIELD_WEIGHTS
+        ]))
+
+    def index_product(self, product):
+        Product.objects.filter(pk=product.pk).update(search_vector=product_search_vector())
+
+    def index_products(self, product_ids):
+        Product.objects.filter(pk__in=product_ids).update(search_vector=product_search_vector())
+
+
+class InvertedIndexSearchBackend:
+    """
+    token -> {product_id: score} postings plus a trigram -> vocabulary word
+    index for fuzzy lookups, rebuilt whenever the catalog version changes.
+    Meant for dev/test catalogs, not production sizes.
+    """
+    # Keep the ranking CASE expression bounded
+    max_results = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._postings = {}
+        self._fuzzy_postings = {}
+        self._trigram_words = {}
+
+    def search(self, queryset, term):
+        return self.rank(queryset, self.score(term))
+
+    def fuzzy_search(self, queryset, term):
+        return self.rank(queryset, self.fuzzy_score(term))
+
+    def rank(self, queryset, scores):
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:self.max_results]
+        if not ranked:
+            return queryset.none().annotate(rank=Value(0.0, output_field=FloatField()))
+
+        return queryset.filter(id__in=[pk for pk, _ in ranked]).annotate(
+            rank=Case(
+                *[When(id=pk, then=Value(score)) for pk, score in ranked],
+                default=Value(0.0),
+                output_field=FloatField(),
+            )
+        )
+
+    def score(self, term):
+        postings = self.get_postings()
+        tokens = set(tokenize(term))
+        if not tokens:
+            return {}
+
+        # Every token has to match, like websearch_to_tsquery's implicit AND
+        matches = None
+        for token in tokens:
+            token_postings = postings.get(token, {})
+            if matches is None:
+                matches = dict(token_postings)
+            else:
+                matches = {pk: score + token_postings[pk] for pk, score in matches.items() if pk in token_postings}
+            if not matches:
+                return {}
+        return matches
+
+    def fuzzy_score(self, term):
+        self.ensure_built()
+        tokens = set(tokenize(term))
+        if not tokens:
+            return {}
+
+        matches = None
+        for token in tokens:
+            token_scores = {}
+            for word, similarity in self.similar_words(token):
+                for pk, weight in self._fuzzy_postings[word].items():
+                    token_scores[pk] = max(token_scores.get(pk, 0.0), similarity * weight)
+            if matches is None:
+                matches = token_scores
+            else:
+                matches = {pk: score + token_scores[pk] for pk, score in matches.items() if pk in token_scores}
+            if not matches:
+                return {}
+        return matches
+
+    def similar_words(self, token):
+        """Vocabulary words sharing enough trigrams with `token`, found through the trigram index."""
+        token_trigrams = trigrams(token)
+        shared = Counter()
+        for trigram in token_trigrams:
+            shared.update(self._trigram_words.get(trigram, ()))
+
+        threshold = settings.PRODUCT_FUZZY_THRESHOLD
+        for word, count in shared.items():
+            similarity = count / (len(token_trigrams) + len(trigrams(word)) - count)
+            if similarity >= threshold:
+                yield word, similarity
+
+    def index_product(self, product):
+        # The catalog version bump on commit triggers a rebuild
+        pass
+
+    def index_products(self, product_ids):
+        pass
+
+    def get_postings(self):
+        self.ensure_built()
+        return self._postings
+
+    def ensure_built(self):
+        version = get_catalog_version()
+        if self._version != version:
+            with self._lock:
+                if self._version != version:
+                    self.build()
+                    self._version = version
+
+    def build(self):
+        postings = defaultdict(lambda: defaultdict(float))
+        fuzzy_postings = defaultdict(dict)
+        fuzzy_weights = dict(FUZZY_FIELD_WEIGHTS)
+        fields = [name for name, _ in FIELD_WEIGHTS]
+        for row in Product.objects.values_list('id', *fields).iterator(chunk_size=2000):
+            pk = row[0]
+            for (name, weight), text in zip(FIELD_WEIGHTS, row[1:]):
+                for token in tokenize(text):
+                    postings[token][pk] += weight
+                    if name in fuzzy_weights:
+                        fuzzy_postings[token][pk] = max(fuzzy_postings[token].get(pk, 0.0), fuzzy_weights[name])
+
+        trigram_words = defaultdict(set)
+        for word in fuzzy_postings:
+            for trigram in trigrams(word):
+                trigram_words[trigram].add(word)
+
+        self._postings = {token: dict(docs) for token, docs in postings.items()}
+        self._fuzzy_postings = dict(fuzzy_postings)
+        self._trigram_words = dict(trigram_words)
+
+
+_backends = {}
+
+
+def get_search_backend():
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == 'postgresql':
+            _backends[vendor] = PostgresSearchBackend()
+        else:
+            _backends[vendor] = InvertedIndexSearchBackend()
+    return _backends[vendor]
@@ -1,12 +1,23 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import *
+from .images import variant_urls
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """URLs of the resized copies of an image, {preset: {format: url}}"""
+
+    def to_representation(self, value):
+        return variant_urls(value, self.context.get('request'))
 
 
 class CategoryListSerializer(serializers.ModelSerializer):
     image = serializers.ImageField(use_url=True)
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Category
-        fields = ['id', 'name', 'image']
+        fields = ['id', 'name', 'image', 'image_variants']
 
 class CompanySerializer(serializers.ModelSerializer):
     class Meta:
@@ -14,21 +25,50 @@ class CompanySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'logo']
 
 
+class ProductImageSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
+    class Meta:
+        model = ProductImage
+        fields = ['id', 'image', 'image_variants', 'alt_text', 'is_primary', 'order']
+
+
+def primary_image_prefetch(prefix=''):
+    """Loads the primary gallery image of every product in one query, read by ProductListSerializer.
+
+    `prefix` is the lookup path to the products, e.g. 'items__product__' for carts.
+    """
+    return Prefetch(f'{prefix}images', queryset=ProductImage.objects.filter(is_primary=True), to_attr='primary_images')
+
+
 class ProductListSerializer(serializers.ModelSerializer):
     image = serializers.ImageField(use_url=True)
+    image_variants = ImageVariantsField()
     category = CategoryListSerializer()
     company = CompanySerializer()
+    primary_image = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'image', 'original_price', 'discounted_price', 'category', 'rating', 'company', 'grams']
+        fields = ['id', 'name', 'image', 'image_variants', 'primary_image', 'original_price', 'discounted_price', 'category', 'rating', 'company', 'grams']
+
+    def get_primary_image(self, obj):
+        # Set by primary_image_prefetch(); other callers pay one query per product
+        images = getattr(obj, 'primary_images', None)
+        if images is None:
+            images = obj.images.filter(is_primary=True)[:1]
+        if not images:
+            return None
+        return ProductImageSerializer(images[0], context=self.context).data
 
 
 class ProductDetailSerializer(serializers.ModelSerializer):
     company = CompanySerializer()
+    gallery = ProductImageSerializer(source='images', many=True, read_only=True)
+
     class Meta:
         model = Product
-        fields = ['id', 'name', 'original_price', 'discounted_price', 'category', 'rating', 'company', 'description', 'image', 'ingredients', 'grams']
+        fields = ['id', 'name', 'original_price', 'discounted_price', 'category', 'rating', 'company', 'description', 'image', 'gallery', 'ingredients', 'grams']
 
 
 class AddToCartSerializer(serializers.Serializer):
@@ -38,12 +78,13 @@ class AddToCartSerializer(serializers.Serializer):
 
 class CompanyListSerializer(serializers.ModelSerializer):
     logo = serializers.SerializerMethodField()
+    logo_variants = ImageVariantsField()
     categories = serializers.SerializerMethodField()
     product_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Company
-        fields = ['id', 'name', 'logo', 'rating', 'description', 'phone_number', 'categories', 'product_count']
+        fields = ['id', 'name', 'logo', 'logo_variants', 'rating', 'description', 'phone_number', 'categories', 'product_count']
 
     def get_logo(self, obj):
         if obj.logo:
@@ -54,9 +95,31 @@ class CompanyListSerializer(serializers.ModelSerializer):
         return None
 
     def get_categories(self, obj):
+        # Precomputed for the whole page by the list view when available
+        categories_by_company = self.context.get('company_categories')
+        if categories_by_company is not None:
+            return categories_by_company.get(obj.id, [])
         # Get unique categories from all products of this company
         categories = Product.objects.filter(company=obj).values_list('category__name', flat=True).distinct()
         return list(categories)
 
     def get_product_count(self, obj):
+        if hasattr(obj, 'product_count'):
+            return obj.product_count
         return Product.objects.filter(company=obj).count()
+
+
+class ProductReviewSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+    helpful_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProductReview
+        fields = ['id', 'product', 'username', 'rating', 'title', 'comment',
+                  'is_verified_purchase', 'helpful_count', 'created_at', 'updated_at']
+        read_only_fields = ['product', 'is_verified_purchase']
+
+    def get_helpful_count(self, obj):
+        # Votes not yet flushed by product.tasks.flush_review_helpful_votes
+        pending = self.context.get('pending_helpful', {})
+        return obj.helpful_count + pending.get(obj.id, 0)
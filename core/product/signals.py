@@ -0,0 +1,89 @@
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .catalog import bump_catalog_version, invalidate_product_details
+from .models import Product, ProductImage, ProductReview, Category, Company, Tag
+from .images import IMAGE_FIELDS, variants_outdated
+from .reviews import apply_rating_change
+from .search import get_search_backend
+from .tasks import generate_image_variants
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def catalog_changed(sender, instance, **kwargs):
+    # Bump after commit so a concurrent reader can't rebuild from pre-commit data
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(m2m_changed, sender=Product.tag_set.through)
+def product_tags_changed(sender, instance, action, **kwargs):
+    # m2m_changed also fires before every change, which would bump twice
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        catalog_changed(sender, instance, **kwargs)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: invalidate_product_details([product_id]))
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def gallery_changed(sender, instance, **kwargs):
+    product_id = instance.product_id
+    transaction.on_commit(lambda: invalidate_product_details([product_id]))
+
+
+@receiver(post_save, sender=Company)
+def company_changed(sender, instance, created=False, **kwargs):
+    # Product details embed the company name and logo
+    if created:
+        return
+    product_ids = list(instance.products.values_list('id', flat=True))
+    transaction.on_commit(lambda: invalidate_product_details(product_ids))
+
+
+@receiver(post_delete, sender=ProductReview)
+def review_deleted(sender, instance, **kwargs):
+    # Also covers admin and queryset deletes and cascades from a deleted user
+    product = Product.objects.filter(pk=instance.product_id).only('id', 'company_id').first()
+    if product is not None:
+        apply_rating_change(product, removed=instance.rating)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    get_search_backend().index_product(instance)
+
+
+@receiver(post_save, sender=Product)
+def sync_product_tags(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'tags' in update_fields:
+        instance.sync_tags()
+
+
+def image_uploaded(sender, instance, update_fields=None, **kwargs):
+    image_field, variants_field = IMAGE_FIELDS[sender._meta.label]
+    if update_fields is not None and not {image_field, variants_field} & set(update_fields):
+        return
+    # A full save from a stale instance may also write back old variants, caught here as well
+    if variants_outdated(instance):
+        label, pk = sender._meta.label, instance.pk
+        transaction.on_commit(lambda: generate_image_variants.delay(label, pk))
+
+
+for label in IMAGE_FIELDS:
+    post_save.connect(image_uploaded, sender=apps.get_model(label), dispatch_uid=f'image_uploaded_{label}')
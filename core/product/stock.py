@@ -0,0 +1,212 @@
+"""
+Race-free stock changes.
+
+reserve_stock() takes every line of an order in a single conditional UPDATE:
+each row is only decremented while it is available and has enough stock, and
+`is_available` is switched off in the same statement when a row runs out.
+PostgreSQL re-checks the WHERE clause after waiting on a row lock, so two
+checkouts can't both take the last unit. If fewer rows matched than were asked
+for, the decrement is rolled back to a savepoint and InsufficientStock says
+which lines were short.
+
+A product that sells faster than one row lock allows can be switched to the
+high-contention mode with set_stock_buckets(). Its stock is then spread over
+N StockBucket rows and each reservation decrements a random bucket, falling
+back to the fullest one and, when no single bucket covers the line, to taking
+from several under lock. The product row itself is only written when the
+last bucket runs empty, whichever path took the last units. For these
+products stock_quantity is a total refreshed by rebalance_stock(), which also
+evens the buckets out.
+"""
+
+import random
+
+from django.db import transaction
+from django.db.models import Case, Exists, F, IntegerField, Q, Subquery, Sum, Value, When
+
+from .models import Product, StockBucket
+
+
+class InsufficientStock(Exception):
+    def __init__(self, available):
+        # product id -> units left, for every line that couldn't be filled
+        self.available = available
+        super().__init__(f'Not enough stock for products {sorted(available)}')
+
+
+def _delta(quantities):
+    return Case(
+        *[When(pk=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def _split(total, buckets):
+    share, rest = divmod(total, buckets)
+    return [share + (index < rest) for index in range(buckets)]
+
+
+def _sharded(product_ids):
+    """{product_id: (bucket count, is_available)} for the given products in high-contention mode."""
+    rows = Product.objects.filter(pk__in=product_ids, stock_buckets__gt=0)
+    return {product_id: (buckets, available) for product_id, buckets, available
+            in rows.values_list('id', 'stock_buckets', 'is_available')}
+
+
+def _mark_sold_out(product_id):
+    # Matches (and so writes the hot row) only once every bucket is empty
+    Product.objects.filter(pk=product_id).exclude(
+        Exists(StockBucket.objects.filter(product_id=product_id, quantity__gt=0)),
+    ).update(stock_quantity=0, is_available=False)
+
+
+def _take_from_buckets(product_id, quantity, buckets):
+    product_buckets = StockBucket.objects.filter(product_id=product_id)
+    take = {'quantity': F('quantity') - quantity}
+    # A random bucket, so concurrent checkouts of the same product lock different rows
+    if product_buckets.filter(index=random.randrange(buckets), quantity__gte=quantity).update(**take):
+        _mark_sold_out(product_id)
+        return True
+    fullest = product_buckets.filter(quantity__gte=quantity).order_by('-quantity').values('pk')[:1]
+    if product_buckets.filter(pk=Subquery(fullest), quantity__gte=quantity).update(**take):
+        _mark_sold_out(product_id)
+        return True
+
+    # No bucket covers the line alone: lock them all, in index order so two drains can't deadlock
+    rows = list(product_buckets.select_for_update().order_by('index').values_list('pk', 'quantity'))
+    total = sum(units for _, units in rows)
+    if total < quantity:
+        return False
+    taken, remaining = {}, quantity
+    for pk, units in rows:
+        if units and remaining:
+            taken[pk] = min(units, remaining)
+            remaining -= taken[pk]
+    product_buckets.filter(pk__in=taken).update(quantity=F('quantity') - _delta(taken))
+    _mark_sold_out(product_id)
+    return True
+
+
+def reserve_stock(quantities):
+    """Take `quantities` ({product_id: units}) out of stock, all or nothing."""
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    if not quantities:
+        return
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError('reserve_stock() must run inside transaction.atomic()')
+
+    sharded = _sharded(quantities)
+    plain = {product_id: quantity for product_id, quantity in quantities.items() if product_id not in sharded}
+    try:
+        # Savepoint, so the lines that did match are put back before the shortfall is looked up
+        with transaction.atomic():
+            if plain:
+                enough = Q()
+                for product_id, quantity in plain.items():
+                    enough |= Q(pk=product_id, stock_quantity__gte=quantity)
+                delta = _delta(plain)
+                updated = Product.objects.filter(enough, is_available=True).update(
+                    stock_quantity=F('stock_quantity') - delta,
+                    # Both sides see the row before the update
+                    is_available=Case(When(stock_quantity__gt=delta, then=Value(True)), default=Value(False)),
+                )
+                if updated < len(plain):
+                    raise InsufficientStock({})
+            for product_id in sorted(sharded):
+                buckets, available = sharded[product_id]
+                if not available or not _take_from_buckets(product_id, quantities[product_id], buckets):
+                    raise InsufficientStock({})
+    except InsufficientStock:
+        rows = Product.objects.filter(pk__in=quantities).values_list('id', 'stock_quantity', 'is_available')
+        units_left = dict(
+            StockBucket.objects.filter(product_id__in=sharded)
+            .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+        )
+        stock = {
+            product_id: units_left.get(product_id, units) if available else 0
+            for product_id, units, available in rows
+        }
+        raise InsufficientStock({
+            product_id: stock.get(product_id, 0) for product_id, quantity in quantities.items()
+            if stock.get(product_id, 0) < quantity
+        })
+
+
+def release_stock(quantities):
+    """Put `quantities` ({product_id: units}) back, making those products available again."""
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    if not quantities:
+        return
+    sharded = _sharded(quantities)
+    plain = {product_id: quantity for product_id, quantity in quantities.items() if product_id not in sharded}
+    if plain:
+        Product.objects.filter(pk__in=plain).update(
+            stock_quantity=F('stock_quantity') + _delta(plain),
+            is_available=True,
+        )
+    for product_id, (buckets, _) in sharded.items():
+        StockBucket.objects.filter(product_id=product_id, index=random.randrange(buckets)).update(
+            quantity=F('quantity') + quantities[product_id],
+        )
+    if sharded:
+        # Only touch the hot row if it had sold out
+        Product.objects.filter(pk__in=sharded, is_available=False).update(is_available=True)
+
+
+def _lock_buckets(product_id):
+    # In index order, like the drain in _take_from_buckets, so they can't deadlock
+    rows = StockBucket.objects.select_for_update().filter(product_id=product_id).order_by('index')
+    return dict(rows.values_list('index', 'quantity'))
+
+
+def _fill_buckets(product_id, indexes, total):
+    StockBucket.objects.filter(product_id=product_id).update(quantity=Case(
+        *[When(index=index, then=Value(units)) for index, units in zip(indexes, _split(total, len(indexes)))],
+        output_field=IntegerField(),
+    ))
+
+
+def set_stock_buckets(product_id, buckets):
+    """Spread a product's stock over `buckets` StockBucket rows; 0 turns the high-contention mode off."""
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product_id)
+        total = product.stock_quantity
+        if product.stock_buckets:
+            total = sum(_lock_buckets(product_id).values())
+        product.buckets.all().delete()
+        StockBucket.objects.bulk_create([
+            StockBucket(product=product, index=index, quantity=units)
+            for index, units in enumerate(_split(total, buckets) if buckets else [])
+        ])
+        Product.objects.filter(pk=product_id).update(stock_buckets=buckets, stock_quantity=total)
+    return total
+
+
+def reset_bucket_stock(quantities):
+    """
+    Spread new stock levels ({product_id: units}) over the buckets of the products in high-contention mode.
+
+    Every write of stock_quantity has to come through here (Product.save, bulk patches, imports),
+    or the next rebalance overwrites it with the bucket total.
+    """
+    with transaction.atomic():
+        for product_id in sorted(_sharded(quantities)):
+            indexes = _lock_buckets(product_id)
+            if indexes:
+                _fill_buckets(product_id, list(indexes), quantities[product_id])
+
+
+def rebalance_stock(product_id):
+    """Even out a product's buckets and store their total in stock_quantity. Returns the total."""
+    with transaction.atomic():
+        buckets = _lock_buckets(product_id)
+        if not buckets:
+            return None
+        total = sum(buckets.values())
+        _fill_buckets(product_id, list(buckets), total)
+        changes = {'stock_quantity': total}
+        if not total:
+            changes['is_available'] = False
+        Product.objects.filter(pk=product_id).update(**changes)
+    return total
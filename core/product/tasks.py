@@ -0,0 +1,47 @@
+from celery import shared_task
+
+from .catalog import bump_catalog_version, invalidate_product_details, refresh_ratings
+from .helpful import flush_helpful_votes
+from .holds import release_expired_holds
+from .images import fetch_product_image, refresh_variants
+from .models import Product, ProductImage
+from .stock import rebalance_stock
+
+
+@shared_task
+def flush_review_helpful_votes():
+    return flush_helpful_votes()
+
+
+@shared_task
+def refresh_listed_ratings():
+    return refresh_ratings()
+
+
+@shared_task
+def release_expired_stock_holds():
+    return release_expired_holds()
+
+
+@shared_task
+def rebalance_stock_buckets():
+    product_ids = list(Product.objects.filter(stock_buckets__gt=0).values_list('id', flat=True))
+    for product_id in product_ids:
+        rebalance_stock(product_id)
+    return len(product_ids)
+
+
+@shared_task(ignore_result=True)
+def generate_image_variants(model_label, pk):
+    # Written with a queryset update, so the catalog snapshots are invalidated here
+    if not refresh_variants(model_label, pk) or not model_label.startswith('product.'):
+        return
+    bump_catalog_version()
+    if model_label == 'product.ProductImage':
+        # Gallery entries are part of the cached product detail
+        invalidate_product_details(ProductImage.objects.filter(pk=pk).values_list('product_id', flat=True))
+
+
+@shared_task(ignore_result=True, autoretry_for=(OSError,), retry_backoff=True, max_retries=3)
+def download_product_image(product_id, url):
+    fetch_product_image(product_id, url)
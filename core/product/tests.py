@@ -1,3 +1,950 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from PIL import Image
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from common.cache import cached
+from .autocomplete import prefix_index
+from order.models import Order, OrderItem
+from user.models import MyUser
+
+from .catalog import get_catalog_version, refresh_ratings
+from .helpful import FLUSH_LOCK_KEY, flush_helpful_votes
+from .images import PinnedAdapter, fetch_product_image
+from .models import Category, Company, Product, ProductImage, ProductReview
+from .tasks import flush_review_helpful_votes, generate_image_variants
+
+
+class CatalogTestMixin:
+    """Creates a small catalog shared by the product tests"""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.company = Company.objects.create(name='Burger House')
+        self.category = Category.objects.create(name='Burgers')
+        self.other_category = Category.objects.create(name='Drinks')
+        self.burger = Product.objects.create(
+            name='Cheeseburger', description='Beef and cheese', original_price=Decimal('1500.00'),
+            category=self.category, company=self.company, stock_quantity=10,
+        )
+        self.cola = Product.objects.create(
+            name='Cola', description='Cold drink', original_price=Decimal('400.00'),
+            category=self.other_category, company=self.company, stock_quantity=50,
+        )
+
+
+class MainPageSnapshotTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/main_page/'
+
+    def test_snapshot_is_served_from_cache(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(len(data['products']), 2)
+        self.assertEqual(len(data['categories']), 2)
+        self.assertIsNone(data['cart'])
+
+        # Anonymous hit on a warm snapshot must not touch the database
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+    def test_category_filter(self):
+        response = self.client.get(self.url, {'category': self.other_category.id})
+        self.assertEqual([p['name'] for p in response.json()['products']], ['Cola'])
+
+        response = self.client.get(self.url, {'category': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_change_invalidates_snapshot(self):
+        self.client.get(self.url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cola.name = 'Cola Zero'
+            self.cola.save()
+
+        names = [p['name'] for p in self.client.get(self.url).json()['products']]
+        self.assertIn('Cola Zero', names)
+
+
+class ProductSearchPaginationTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/search/'
+
+    def setUp(self):
+        super().setUp()
+        # Duplicate prices and missing ratings exercise the id tiebreaker and null handling
+        for i in range(7):
+            Product.objects.create(
+                name=f'Combo {i}', description='Combo meal', original_price=Decimal('900.00'),
+                category=self.category, company=self.company,
+                rating=Decimal('4.50') if i % 2 else None,
+            )
+
+    def collect(self, params):
+        ids, url, pages = [], self.url, 0
+        while url:
+            response = self.client.get(url, params if pages == 0 else None)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [p['id'] for p in response.json()['results']]
+            url = response.json()['next']
+            pages += 1
+        return ids, pages
+
+    def test_pages_cover_every_product_once(self):
+        expected = set(Product.objects.values_list('id', flat=True))
+        for ordering in ['-created_at', 'original_price', '-original_price', 'rating', '-rating', 'name']:
+            ids, pages = self.collect({'ordering': ordering, 'page_size': 2})
+            self.assertEqual(len(ids), len(expected), ordering)
+            self.assertEqual(set(ids), expected, ordering)
+            self.assertEqual(pages, 5, ordering)
+
+    def test_page_does_not_count(self):
+        # The page and the primary images prefetch
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'page_size': 3})
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Well-formed cursors carrying values of the wrong type
+        for ordering, value, pk in [('-created_at', 'yesterday', 1), ('original_price', 'cheap', 1),
+                                    ('rating', ['x'], 1), ('original_price', '100', 10 ** 30)]:
+            field = ordering.lstrip('-')
+            cursor = base64.urlsafe_b64encode(json.dumps([field, value, pk]).encode()).decode()
+            response = self.client.get(self.url, {'ordering': ordering, 'cursor': cursor})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, (ordering, value))
+
+
+class ProductFullTextSearchTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/search/'
+
+    def setUp(self):
+        super().setUp()
+        self.cola.tags = 'burger, combo'
+        self.cola.save()
+        Product.objects.create(
+            name='Fries', description='Goes well with a burger', original_price=Decimal('300.00'),
+            category=self.other_category, company=self.company,
+        )
+        Product.objects.create(
+            name='Double Burger', description='Two patties', original_price=Decimal('2100.00'),
+            category=self.category, company=self.company,
+        )
+
+    def test_results_are_ranked_by_field_weight(self):
+        response = self.client.get(self.url, {'search': 'burger'})
+        names = [p['name'] for p in response.json()['results']]
+        # name match > tag match > description match
+        self.assertEqual(names, ['Double Burger', 'Cola', 'Fries'])
+
+        response = self.client.get(self.url, {'search': 'cheeseburger'})
+        self.assertEqual([p['name'] for p in response.json()['results']], ['Cheeseburger'])
+
+    def test_all_terms_must_match(self):
+        response = self.client.get(self.url, {'search': 'burger combo'})
+        self.assertEqual([p['name'] for p in response.json()['results']], ['Cola'])
+
+        response = self.client.get(self.url, {'search': 'pizza'})
+        self.assertEqual(response.json()['results'], [])
+
+
+class ProductFuzzySearchTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/search/'
+
+    def setUp(self):
+        super().setUp()
+        Product.objects.create(
+            name='Chicken Burger', description='Crispy chicken', original_price=Decimal('1700.00'),
+            category=self.category, company=self.company, tags='chicken, spicy',
+        )
+
+    def test_typos_still_match(self):
+        response = self.client.get(self.url, {'search': 'chiken burgr', 'fuzzy': '1'})
+        data = response.json()
+        self.assertEqual([p['name'] for p in data['results']], ['Chicken Burger'])
+        self.assertEqual(data['suggestions'], ['Chicken Burger'])
+        self.assertEqual(data['did_you_mean'], 'chicken burger')
+
+    def test_exact_search_has_no_suggestions(self):
+        response = self.client.get(self.url, {'search': 'chiken burgr'})
+        self.assertEqual(response.json()['results'], [])
+        self.assertNotIn('suggestions', response.json())
+
+
+class AutocompleteTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/autocomplete/'
+
+    def setUp(self):
+        super().setUp()
+        self.burger.tags = 'beef, Burgers'
+        self.burger.save()
+        # The index is shared by the process; make every test see its own catalog
+        self.enterContext(mock.patch.object(prefix_index, 'version_check_interval', 0))
+
+    def test_prefix_matches_products_restaurants_and_tags(self):
+        response = self.client.get(self.url, {'q': 'bur'})
+        results = response.json()['results']
+        self.assertEqual(
+            [(r['type'], r['text']) for r in results],
+            [('restaurant', 'Burger House'), ('tag', 'burgers')],
+        )
+
+        # Later words of a name are matched too
+        results = self.client.get(self.url, {'q': 'HOUSE'}).json()['results']
+        self.assertEqual([r['text'] for r in results], ['Burger House'])
+
+    def test_keystrokes_do_not_query_the_database(self):
+        self.client.get(self.url, {'q': 'c'})
+        with self.assertNumQueries(0):
+            results = self.client.get(self.url, {'q': 'ch'}).json()['results']
+        self.assertEqual([r['text'] for r in results], ['Cheeseburger'])
+
+    def test_limit_is_clamped(self):
+        for limit in ['-5', '0', '1']:
+            results = self.client.get(self.url, {'q': 'bur', 'limit': limit}).json()['results']
+            self.assertEqual(len(results), 1, limit)
+
+
+class ProductSearchFacetsTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/search/'
+
+    def setUp(self):
+        super().setUp()
+        self.burger.rating = Decimal('4.70')
+        self.burger.save()
+        other = Company.objects.create(name='Pizza Place')
+        Product.objects.create(
+            name='Cheese Pizza', description='Cheese', original_price=Decimal('2500.00'),
+            category=self.category, company=other, rating=Decimal('3.20'),
+        )
+
+    def test_facets_in_one_query(self):
+        response = self.client.get(self.url, {'facets': '1', 'page_size': 1})
+        facets = response.json()['facets']
+
+        self.assertEqual(
+            [(c['name'], c['count']) for c in facets['category']],
+            [('Burgers', 2), ('Drinks', 1)],
+        )
+        self.assertEqual(
+            [(c['name'], c['count']) for c in facets['company']],
+            [('Burger House', 2), ('Pizza Place', 1)],
+        )
+        self.assertEqual(
+            {p['bucket']: p['count'] for p in facets['price'] if p['count']},
+            {'0-500': 1, '1000-2000': 1, '2000-5000': 1},
+        )
+        self.assertEqual(
+            {r['bucket']: r['count'] for r in facets['rating'] if r['count']},
+            {'4+': 1, '3-4': 1, 'unrated': 1},
+        )
+
+        # The page, its primary images and one query for all facets
+        with self.assertNumQueries(3):
+            self.client.get(self.url, {'facets': '1'})
+
+    def test_facets_follow_the_filters(self):
+        response = self.client.get(self.url, {'facets': '1', 'search': 'cheese'})
+        facets = response.json()['facets']
+        self.assertEqual([(c['name'], c['count']) for c in facets['category']], [('Burgers', 2)])
+
+
+class ProductTagFilterTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.burger.tags = 'Steak,  beef'
+        self.burger.save()
+        self.cola.tags = 'tea, cold'
+        self.cola.save()
+
+    def test_tags_are_split_into_tag_rows(self):
+        self.assertEqual(sorted(self.burger.tag_set.values_list('name', flat=True)), ['beef', 'steak'])
+
+        self.burger.tags = 'beef'
+        self.burger.save()
+        self.assertEqual(list(self.burger.tag_set.values_list('name', flat=True)), ['beef'])
+
+    def test_tag_change_bumps_the_catalog_once(self):
+        tag = self.cola.tag_set.get(name='tea')
+        with mock.patch('product.signals.bump_catalog_version') as bump:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.burger.tag_set.add(tag)
+            self.assertEqual(bump.call_count, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.burger.tag_set.clear()
+            self.assertEqual(bump.call_count, 2)
+
+    def test_search_filters_by_exact_tag(self):
+        response = self.client.get('/api/product/search/', {'tag': 'tea'})
+        self.assertEqual([p['name'] for p in response.json()['results']], ['Cola'])
+
+        response = self.client.get('/api/product/search/', {'tag': ['TEA', 'beef']})
+        self.assertEqual(response.json()['results'], [])
+
+    def test_main_page_filters_by_tag(self):
+        response = self.client.get('/api/product/main_page/', {'tag': 'Beef'})
+        self.assertEqual([p['name'] for p in response.json()['products']], ['Cheeseburger'])
+
+
+class RandomProductTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/get_random_product/'
+
+    def test_filters(self):
+        response = self.client.get(self.url, {'category': self.other_category.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['name'], 'Cola')
+
+        response = self.client.get(self.url, {'company': 0, 'available': 'true'})
+        self.assertIn(response.json()['name'], ['Cheeseburger', 'Cola'])
+
+        response = self.client.get(self.url, {'category': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_warm_pick_loads_one_row(self):
+        self.client.get(self.url)
+        # The row and its gallery
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+
+    def test_no_match(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cola.is_available = False
+            self.cola.save()
+        response = self.client.get(self.url, {'category': self.other_category.id, 'available': '1'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RestaurantListTestCase(CatalogTestMixin, TestCase):
+    url = '/api/product/restaurants/'
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            company = Company.objects.create(name=f'Pizza Place {i}')
+            Product.objects.create(
+                name=f'Pizza {i}', description='Pizza', original_price=Decimal('2500.00'),
+                category=self.category, company=company,
+            )
+
+    def test_query_count_does_not_grow_with_companies(self):
+        # One query for the annotated companies, one for their categories
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        data = {c['name']: c for c in response.json()}
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data['Burger House']['categories'], ['Burgers', 'Drinks'])
+        self.assertEqual(data['Burger House']['product_count'], 2)
+        self.assertEqual(data['Pizza Place 0']['product_count'], 1)
+
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+    def test_category_filter_and_invalidation(self):
+        response = self.client.get(self.url, {'category': 'drinks'})
+        self.assertEqual([c['name'] for c in response.json()], ['Burger House'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                name='Lemonade', description='Drink', original_price=Decimal('300.00'),
+                category=self.other_category, company=Company.objects.get(name='Pizza Place 1'),
+            )
+        response = self.client.get(self.url, {'category': 'Drinks'})
+        self.assertEqual(sorted(c['name'] for c in response.json()), ['Burger House', 'Pizza Place 1'])
+
+    @override_settings(SITE_ORIGIN='https://api.example.com')
+    def test_urls_ignore_the_host_header(self):
+        self.company.logo = 'companies/burger.png'
+        self.company.save()
+        response = self.client.get(self.url, HTTP_HOST='evil.example')
+        logos = {c['name']: c['logo'] for c in response.json()}
+        self.assertEqual(logos['Burger House'], 'https://api.example.com/media/companies/burger.png')
+
+        # One cached payload for every Host header
+        with self.assertNumQueries(0):
+            self.client.get(self.url, HTTP_HOST='other.example')
+
+
+class ProductReviewTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [MyUser.objects.create_user(f'user{i}', f'user{i}@example.com', 'pass') for i in range(3)]
+        self.client.force_authenticate(self.users[0])
+
+    def review(self, user, rating, product=None):
+        self.client.force_authenticate(user)
+        product = product or self.burger
+        return self.client.post(f'/api/product/product/{product.id}/reviews/', {
+            'rating': rating, 'title': 'Title', 'comment': 'Comment',
+        })
+
+    def assertAggregates(self, obj, rating_sum, rating_count, rating):
+        obj.refresh_from_db()
+        self.assertEqual((obj.rating_sum, obj.rating_count, obj.rating), (rating_sum, rating_count, rating))
+
+    def test_aggregates_follow_review_writes(self):
+        self.assertEqual(self.review(self.users[0], 5).status_code, status.HTTP_201_CREATED)
+        self.review(self.users[1], 4)
+        self.review(self.users[2], 2, product=self.cola)
+        self.assertAggregates(self.burger, 9, 2, Decimal('4.50'))
+        self.assertAggregates(self.company, 11, 3, Decimal('3.67'))
+
+        review = ProductReview.objects.get(user=self.users[1])
+        self.client.force_authenticate(self.users[1])
+        response = self.client.put(f'/api/product/reviews/{review.id}/', {'rating': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertAggregates(self.burger, 6, 2, Decimal('3.00'))
+
+        self.client.delete(f'/api/product/reviews/{review.id}/')
+        self.client.force_authenticate(self.users[0])
+        self.client.delete(f'/api/product/reviews/{ProductReview.objects.get(user=self.users[0]).id}/')
+        self.assertAggregates(self.burger, 0, 0, None)
+        self.assertAggregates(self.company, 2, 1, Decimal('2.00'))
+
+    def test_reviews_reach_the_listings_without_a_catalog_bump(self):
+        listing = APIClient()
+
+        def listed_rating():
+            products = listing.get('/api/product/main_page/').json()['products']
+            return next(product['rating'] for product in products if product['id'] == self.burger.id)
+
+        version = get_catalog_version()
+        self.assertIsNone(listed_rating())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.review(self.users[0], 4)
+        self.assertEqual(get_catalog_version(), version)
+        self.assertIsNone(listed_rating())
+
+        self.assertTrue(refresh_ratings())
+        self.assertEqual(listed_rating(), '4.00')
+        self.assertFalse(refresh_ratings())
+
+    def test_deleting_the_author_removes_their_ratings(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[0], 1, product=self.cola)
+        self.review(self.users[1], 3)
+        self.users[0].delete()
+        self.assertAggregates(self.burger, 3, 1, Decimal('3.00'))
+        self.assertAggregates(self.company, 3, 1, Decimal('3.00'))
+        self.cola.refresh_from_db()
+        self.assertEqual((self.cola.rating_count, self.cola.rating_histogram['1']), (0, 0))
+
+    def test_one_review_per_user(self):
+        self.review(self.users[0], 5)
+        response = self.review(self.users[0], 3)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertAggregates(self.burger, 5, 1, Decimal('5.00'))
+
+    def test_only_the_author_can_edit(self):
+        self.review(self.users[0], 5)
+        review = ProductReview.objects.get()
+        self.client.force_authenticate(self.users[1])
+        response = self.client.put(f'/api/product/reviews/{review.id}/', {'rating': 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_verified_purchase(self):
+        order = Order.objects.create(user=self.users[0], status='delivered', total_price=Decimal('1500.00'))
+        OrderItem.objects.create(order=order, product=self.burger, unit_price=Decimal('1500.00'))
+        self.assertTrue(self.review(self.users[0], 5).json()['is_verified_purchase'])
+        self.assertFalse(self.review(self.users[1], 5).json()['is_verified_purchase'])
+
+    def test_listing_with_histogram(self):
+        for user, rating in zip(self.users, [5, 5, 2]):
+            self.review(user, rating)
+        ProductReview.objects.filter(user=self.users[2]).update(helpful_count=7)
+        url = f'/api/product/product/{self.burger.id}/reviews/'
+        self.client.logout()
+
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'page_size': 2})
+        data = response.json()
+        self.assertEqual(data['histogram'], {'1': 0, '2': 1, '3': 0, '4': 0, '5': 2})
+        self.assertEqual(data['rating_count'], 3)
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(len(self.client.get(data['next']).json()['results']), 1)
+
+        data = self.client.get(url, {'ordering': '-helpful_count'}).json()
+        self.assertEqual(data['results'][0]['username'], 'user2')
+
+        review = ProductReview.objects.get(user=self.users[2])
+        self.client.force_authenticate(self.users[2])
+        self.client.put(f'/api/product/reviews/{review.id}/', {'rating': 5})
+        self.assertEqual(self.client.get(url).json()['histogram']['5'], 3)
+
+
+class ReviewHelpfulVotesTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.author, *self.voters = [
+            MyUser.objects.create_user(f'user{i}', f'user{i}@example.com', 'pass') for i in range(3)
+        ]
+        self.review = ProductReview.objects.create(
+            product=self.burger, user=self.author, rating=5, title='Title', comment='Comment', helpful_count=4,
+        )
+        self.url = f'/api/product/reviews/{self.review.id}/helpful/'
+
+    def vote(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post(self.url)
+
+    def test_votes_are_deduplicated_and_flushed(self):
+        self.assertEqual(self.vote(self.voters[0]).json(), {'helpful_count': 5, 'voted': True})
+        self.assertEqual(self.vote(self.voters[0]).json(), {'helpful_count': 5, 'voted': False})
+        self.vote(self.voters[1])
+        self.assertEqual(self.vote(self.author).status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Not written yet, but reads already include the pending votes
+        self.review.refresh_from_db()
+        self.assertEqual(self.review.helpful_count, 4)
+        listing = self.client.get(f'/api/product/product/{self.burger.id}/reviews/').json()
+        self.assertEqual(listing['results'][0]['helpful_count'], 6)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(flush_review_helpful_votes.apply().get(), 1)
+        self.review.refresh_from_db()
+        self.assertEqual(self.review.helpful_count, 6)
+        self.assertEqual(self.vote(self.voters[1]).json(), {'helpful_count': 6, 'voted': False})
+        self.assertEqual(flush_review_helpful_votes.apply().get(), 0)
+
+    def test_flush_is_skipped_while_another_runs(self):
+        self.vote(self.voters[0])
+        cache.add(FLUSH_LOCK_KEY, 1)
+        self.addCleanup(cache.delete, FLUSH_LOCK_KEY)
+        self.assertEqual(flush_helpful_votes(), 0)
+        self.review.refresh_from_db()
+        self.assertEqual(self.review.helpful_count, 4)
+
+
+class CategoryTreeTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.food = Category.objects.create(name='Food')
+        self.category.parent_category = self.food
+        self.category.save()
+        self.smash = Category.objects.create(name='Smash burgers', parent_category=self.category)
+        Product.objects.create(
+            name='Smash Double', description='Smashed', original_price=Decimal('1900.00'),
+            category=self.smash, company=self.company,
+        )
+
+    def test_paths_follow_moves(self):
+        self.smash.refresh_from_db()
+        self.assertEqual(self.smash.depth, 2)
+        self.assertTrue(self.smash.path.startswith(self.food.path))
+
+        # Moving a category carries its descendants along
+        self.category.parent_category = None
+        self.category.save()
+        self.smash.refresh_from_db()
+        self.assertEqual(self.smash.depth, 1)
+        self.assertFalse(self.smash.path.startswith(self.food.path))
+
+        self.category.parent_category = self.smash
+        with self.assertRaises(ValueError):
+            self.category.save()
+
+    def test_move_with_a_stale_instance(self):
+        # Loaded before its parent moved: the subtree must still be found by its stored path
+        stale = Category.objects.get(pk=self.smash.pk)
+        self.category.parent_category = None
+        self.category.save()
+        stale.parent_category = self.food
+        stale.save()
+        self.smash.refresh_from_db()
+        self.assertEqual(self.smash.path, f'{self.food.path}{self.smash.pk:010d}/')
+        self.assertEqual(self.smash.depth, 1)
+        self.assertEqual(Category.objects.filter(path__startswith=self.smash.path).count(), 1)
+
+    def test_tree_in_one_query(self):
+        with self.assertNumQueries(1):
+            tree = self.client.get('/api/product/categories/tree/').json()
+        food = next(node for node in tree if node['name'] == 'Food')
+        burgers = food['children'][0]
+        self.assertEqual((food['product_count'], food['total_product_count']), (0, 2))
+        self.assertEqual((burgers['product_count'], burgers['total_product_count']), (1, 2))
+        self.assertEqual(burgers['children'][0]['name'], 'Smash burgers')
+
+    def test_subtree_filtering(self):
+        response = self.client.get('/api/product/search/', {'category_tree': self.food.id})
+        self.assertEqual(sorted(p['name'] for p in response.json()['results']), ['Cheeseburger', 'Smash Double'])
+
+        response = self.client.get('/api/product/main_page/', {'category_tree': self.category.id})
+        self.assertEqual(sorted(p['name'] for p in response.json()['products']), ['Cheeseburger', 'Smash Double'])
+
+
+class SingleFlightCacheTestCase(CatalogTestMixin, TestCase):
+    key = 'single_flight_test'
+
+    def test_expired_value_is_served_while_locked(self):
+        cached(self.key, lambda: 'old', ttl=60)
+        entry = cache.get(self.key)
+        entry['expires'] = 0
+        cache.set(self.key, entry)
+
+        # Another worker is recomputing, so the stale value is served without calling compute
+        cache.add(f'{self.key}:lock', 1)
+        self.assertEqual(cached(self.key, mock.Mock(side_effect=AssertionError), ttl=60), 'old')
+
+        cache.delete(f'{self.key}:lock')
+        self.assertEqual(cached(self.key, lambda: 'new', ttl=60), 'new')
+        self.assertIsNone(cache.get(f'{self.key}:lock'))
+
+    def test_product_detail(self):
+        url = f'/api/product/product/{self.burger.id}/'
+        self.assertEqual(self.client.get(url).json()['name'], 'Cheeseburger')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        response = self.client.get('/api/product/product/999999/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIsNone(cache.get('product_detail_999999'))
+
+
+class ProductDetailInvalidationTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = f'/api/product/product/{self.burger.id}/'
+        self.client.get(self.url)
+
+    def test_product_save_and_delete_purge_detail(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.burger.original_price = Decimal('1700.00')
+            self.burger.save()
+        self.assertEqual(self.client.get(self.url).json()['original_price'], '1700.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.burger.delete()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_company_save_purges_detail(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.company.name = 'Burger Palace'
+            self.company.save()
+        self.assertEqual(self.client.get(self.url).json()['company']['name'], 'Burger Palace')
+
+
+class ImageVariantsTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, size=(900, 600)):
+        buffer = io.BytesIO()
+        Image.new('RGBA', size, (200, 30, 30, 128)).save(buffer, 'PNG')
+        return SimpleUploadedFile('burger.png', buffer.getvalue(), content_type='image/png')
+
+    def test_variants_generated_on_upload(self):
+        with mock.patch('product.signals.generate_image_variants.delay', side_effect=generate_image_variants):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.burger.image = self.upload()
+                self.burger.save()
+
+        self.burger.refresh_from_db()
+        variants = self.burger.image_variants
+        self.assertEqual(variants['source'], self.burger.image.name)
+        with Image.open(Product._meta.get_field('image').storage.open(variants['thumb']['webp'])) as thumb:
+            self.assertEqual(thumb.size, (128, 85))
+        with Image.open(Product._meta.get_field('image').storage.open(variants['full']['jpeg'])) as full:
+            # Never upscaled
+            self.assertEqual((full.size, full.mode), ((900, 600), 'RGB'))
+
+        product = next(p for p in self.client.get('/api/product/main_page/').json()['products'] if p['id'] == self.burger.id)
+        self.assertTrue(product['image_variants']['card']['webp'].endswith(variants['card']['webp']))
+
+    def test_same_content_reuses_files(self):
+        self.burger.image = self.upload()
+        self.burger.save()
+        self.cola.image = self.upload()
+        self.cola.save()
+        generate_image_variants('product.Product', self.burger.id)
+        generate_image_variants('product.Product', self.cola.id)
+        self.burger.refresh_from_db()
+        self.cola.refresh_from_db()
+        self.assertNotEqual(self.burger.image.name, self.cola.image.name)
+        self.assertEqual(self.burger.image_variants['thumb'], self.cola.image_variants['thumb'])
+
+    def test_unreadable_image_gets_no_presets(self):
+        self.company.logo = SimpleUploadedFile('logo.svg', b'<svg xmlns="http://www.w3.org/2000/svg"/>')
+        self.company.save()
+        generate_image_variants('product.Company', self.company.id)
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.logo_variants, {'source': self.company.logo.name})
+
+
+class MediaServingTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.hashed = f'derivatives/ab/{"ab" * 32}/128w.webp'
+        for name in (self.hashed, 'products/burger.jpg'):
+            os.makedirs(os.path.dirname(os.path.join(media_root, name)), exist_ok=True)
+            with open(os.path.join(media_root, name), 'wb') as f:
+                f.write(b'0123456789')
+
+    def read(self, response):
+        # serve_media streams from an async generator, so the body is an async iterator
+        async def collect():
+            return b''.join([chunk async for chunk in response.streaming_content])
+        return async_to_sync(collect)()
+
+    def test_full_and_conditional(self):
+        response = self.client.get('/media/products/burger.jpg')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.read(response), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+        response = self.client.get('/media/products/burger.jpg', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get('/media/' + self.hashed)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_ranges(self):
+        response = self.client.get('/media/products/burger.jpg', HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(self.read(response), b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+        response = self.client.get('/media/products/burger.jpg', HTTP_RANGE='bytes=-3')
+        self.assertEqual(self.read(response), b'789')
+
+        response = self.client.get('/media/products/burger.jpg', HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    def test_missing_and_traversal(self):
+        self.assertEqual(self.client.get('/media/products/nope.jpg').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(MEDIA_DELIVERY='x-accel')
+    def test_accel_redirect(self):
+        response = self.client.get('/media/products/burger.jpg')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/products/burger.jpg')
+        self.assertEqual(response.content, b'')
+
+
+class ProductGalleryTestCase(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for product in Product.objects.all():
+            ProductImage.objects.create(product=product, image='products/images/side.jpg', order=1)
+            ProductImage.objects.create(product=product, image='products/images/front.jpg', order=0, is_primary=True)
+
+    def test_list_primary_image_without_per_product_queries(self):
+        # The page and one prefetch, however many products are listed
+        with self.assertNumQueries(2):
+            results = self.client.get('/api/product/search/').json()['results']
+        self.assertEqual(len(results), 2)
+        for product in results:
+            self.assertTrue(product['primary_image']['image'].endswith('front.jpg'))
+
+        products = self.client.get('/api/product/main_page/').json()['products']
+        self.assertTrue(all(p['primary_image']['is_primary'] for p in products))
+
+    def test_detail_gallery(self):
+        gallery = self.client.get(f'/api/product/product/{self.burger.id}/').json()['gallery']
+        self.assertEqual([image['image'].rsplit('/', 1)[1] for image in gallery], ['front.jpg', 'side.jpg'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.burger.images.filter(order=1).delete()
+        gallery = self.client.get(f'/api/product/product/{self.burger.id}/').json()['gallery']
+        self.assertEqual(len(gallery), 1)
+
+
+class ProductImportTestCase(CatalogTestMixin, TestCase):
+    url = '/api/user/manager/import_products/'
+
+    def setUp(self):
+        super().setUp()
+        self.manager = MyUser.objects.create_user('manager', 'manager@example.com', 'pass')
+        self.manager.role = 'manager'
+        self.manager.company = self.company
+        self.manager.save()
+        self.client.force_authenticate(self.manager)
+
+    def upload(self, name, content):
+        with mock.patch('product.importer.download_product_image.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.url, {'file': SimpleUploadedFile(name, content.encode())})
+        self.downloads = [c.args for c in delay.call_args_list]
+        return response
+
+    def test_csv_upsert(self):
+        response = self.upload('menu.csv', (
+            'sku,name,original_price,category,tags,image_url\n'
+            'B1,Double Burger,2100.00,burgers,"Beef, Spicy",https://cdn.example.com/b1.jpg\n'
+            'B2,Veggie Burger,1800.00,Burgers,,\n'
+            'B3,Mystery,100,Sushi,,\n'
+            'B4,No price,,Burgers,,\n'
+        ))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.json()
+        self.assertEqual((report['created'], report['updated'], report['error_count']), (2, 0, 2))
+        self.assertEqual([error['line'] for error in report['errors']], [4, 5])
+        self.assertIn('category', report['errors'][0]['errors'])
+
+        double = Product.objects.get(company=self.company, sku='B1')
+        self.assertEqual(double.category, self.category)
+        self.assertEqual(sorted(double.tag_set.values_list('name', flat=True)), ['beef', 'spicy'])
+        self.assertEqual(self.downloads, [(double.id, 'https://cdn.example.com/b1.jpg')])
+
+        # Re-import updates in place and only touches the columns it has
+        Product.objects.filter(pk=double.pk).update(stock_quantity=7, image_source_url='https://cdn.example.com/b1.jpg')
+        report = self.upload('menu.jsonl', (
+            '{"sku": "B1", "name": "Double Burger XL", "original_price": "2300", "category": "Burgers",'
+            ' "image_url": "https://cdn.example.com/b1.jpg"}\n'
+            'not json\n'
+        )).json()
+        self.assertEqual((report['created'], report['updated'], report['error_count']), (0, 1, 1))
+        double.refresh_from_db()
+        self.assertEqual((double.name, double.original_price, double.stock_quantity), ('Double Burger XL', Decimal('2300.00'), 7))
+        self.assertEqual(self.downloads, [])
+
+    def test_rows_only_update_the_columns_they_give(self):
+        self.upload('menu.jsonl', (
+            '{"sku": "B1", "name": "Double", "original_price": "2100", "category": "Burgers",'
+            ' "stock_quantity": 7, "tags": "beef"}\n'
+            '{"sku": "B2", "name": "Veggie", "original_price": "1800", "category": "Burgers",'
+            ' "stock_quantity": 4, "is_available": false, "tags": "vegan"}\n'
+        ))
+        report = self.upload('menu.jsonl', (
+            '{"sku": "B1", "name": "Double", "original_price": "2100", "category": "Burgers", "stock_quantity": 9}\n'
+            '{"sku": "B2", "name": "Veggie XL", "original_price": "1900", "category": "Burgers"}\n'
+        )).json()
+        self.assertEqual(report['updated'], 2)
+
+        double = Product.objects.get(company=self.company, sku='B1')
+        veggie = Product.objects.get(company=self.company, sku='B2')
+        self.assertEqual((double.stock_quantity, double.tags), (9, 'beef'))
+        self.assertEqual((veggie.name, veggie.stock_quantity, veggie.is_available), ('Veggie XL', 4, False))
+        self.assertEqual(list(veggie.tag_set.values_list('name', flat=True)), ['vegan'])
+
+    def test_categories_are_scoped_to_the_company(self):
+        rival = Company.objects.create(name='Rival')
+        Category.objects.create(name='Drinks', company=rival)
+        own = Category.objects.create(name='Burgers', company=self.company)
+        for parent in (self.category, self.other_category):
+            Category.objects.create(name='Sides', parent_category=parent)
+        report = self.upload('menu.csv', (
+            'sku,name,original_price,category\n'
+            'D1,Lemonade,300,Drinks\n'
+            'B1,Double,2100,burgers\n'
+            'S1,Fries,500,Sides\n'
+            'S2,Fries,500,Burgers / Sides\n'
+        )).json()
+        self.assertEqual([error['line'] for error in report['errors']], [4])
+        self.assertIn('path', report['errors'][0]['errors']['category'][0])
+
+        products = Product.objects.filter(company=self.company)
+        self.assertEqual(products.get(sku='D1').category, self.other_category)
+        self.assertEqual(products.get(sku='B1').category, own)
+        self.assertEqual(products.get(sku='S2').category.parent_category, self.category)
+
+    def test_image_urls_must_be_public(self):
+        for url in ['file:///etc/passwd', 'http://169.254.169.254/latest/meta-data/', 'http://localhost/a.jpg',
+                    'http://10.0.0.5/a.jpg', 'http://[::1]/a.jpg']:
+            with self.subTest(url=url), self.assertRaises(ValueError):
+                fetch_product_image(self.burger.id, url)
+
+        # A public host redirecting into the internal network is stopped before the second request
+        redirect = mock.Mock(is_redirect=True, headers={'Location': 'http://127.0.0.1/admin'})
+        public = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('93.184.216.34', 80))]
+        with mock.patch('product.images.socket.getaddrinfo', side_effect=[public, socket.getaddrinfo('127.0.0.1', 80)]), \
+                mock.patch('product.images.requests.Session.get', autospec=True, return_value=redirect) as get:
+            with self.assertRaises(ValueError):
+                fetch_product_image(self.burger.id, 'https://cdn.example.com/b1.jpg')
+        self.assertEqual(get.call_count, 1)
+        # The request went to the address that was checked, whatever the host resolves to later
+        session = get.call_args.args[0]
+        self.assertEqual(session.get_adapter('https://cdn.example.com/b1.jpg').address, '93.184.216.34')
+
+        request = requests.Request('GET', 'https://cdn.example.com/b1.jpg').prepare()
+        host_params, pool_kwargs = PinnedAdapter('93.184.216.34').build_connection_pool_key_attributes(request, True)
+        self.assertEqual(host_params['host'], '93.184.216.34')
+        self.assertEqual(pool_kwargs['server_hostname'], 'cdn.example.com')
+
+    def test_rejects_unknown_format_and_non_managers(self):
+        self.assertEqual(self.upload('menu.xlsx', 'x').status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.manager.role = 'user'
+        self.manager.save()
+        self.assertEqual(self.upload('menu.csv', 'sku\n').status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ProductBulkUpdateTestCase(CatalogTestMixin, TestCase):
+    url = '/api/user/manager/bulk_update_products/'
+
+    def setUp(self):
+        super().setUp()
+        self.manager = MyUser.objects.create_user('manager', 'manager@example.com', 'pass')
+        self.manager.role = 'manager'
+        self.manager.company = self.company
+        self.manager.save()
+        self.client.force_authenticate(self.manager)
+        self.other = Product.objects.create(
+            name='Rival Burger', description='Elsewhere', original_price=Decimal('1000.00'),
+            category=self.category, company=Company.objects.create(name='Rival'),
+        )
+
+    def patch(self, product_filter, patch):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, {'filter': product_filter, 'patch': patch}, format='json')
+
+    def test_category_promo(self):
+        self.client.get(f'/api/product/product/{self.burger.id}/')
+        response = self.patch({'category': self.category.id}, {'discount_percent': '20'})
+        self.assertEqual(response.json(), {'updated': 1})
+
+        self.burger.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.burger.discounted_price, Decimal('1200.00'))
+        self.assertIsNone(self.other.discounted_price)
+        # Cached detail was purged
+        detail = self.client.get(f'/api/product/product/{self.burger.id}/').json()
+        self.assertEqual(detail['discounted_price'], '1200.00')
+
+        self.patch({'company': self.company.id}, {'discount_percent': '0'})
+        self.burger.refresh_from_db()
+        self.assertIsNone(self.burger.discounted_price)
+
+    def test_sold_out(self):
+        response = self.patch({'ids': [self.burger.id, self.cola.id, self.other.id]}, {'stock_quantity': 0})
+        self.assertEqual(response.json(), {'updated': 2})
+        self.assertFalse(Product.objects.filter(company=self.company, is_available=True).exists())
+        self.assertTrue(Product.objects.get(pk=self.other.pk).is_available)
+
+        # A restock puts them back on sale, unless the patch says otherwise
+        self.patch({'ids': [self.burger.id]}, {'stock_quantity': 5})
+        self.assertTrue(Product.objects.get(pk=self.burger.pk).is_available)
+        self.patch({'ids': [self.cola.id]}, {'stock_quantity': 5, 'is_available': False})
+        self.assertFalse(Product.objects.get(pk=self.cola.pk).is_available)
+
+    def test_validation(self):
+        self.assertEqual(self.patch({}, {'is_available': False}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.patch({'ids': [self.burger.id]}, {}).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.patch({'ids': [self.burger.id]}, {'discounted_price': '1', 'discount_percent': '5'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.patch({'company': self.other.company_id}, {'is_available': False})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -4,9 +4,14 @@ from .views import *
 
 urlpatterns = [
     path('main_page/', MainPageView.as_view(), name='main_page'),
+    path('categories/tree/', CategoryTreeView.as_view(), name='category_tree'),
     path('restaurants/', RestaurantListView.as_view(), name='restaurant_list'),
     path('search/', ProductSearchView.as_view(), name='product_search'),
+    path('autocomplete/', AutocompleteView.as_view(), name='product_autocomplete'),
     path('product/<int:pk>/', ProductDetailView.as_view(), name='product_detail'),
+    path('product/<int:pk>/reviews/', ProductReviewsView.as_view(), name='product_reviews'),
+    path('reviews/<int:pk>/', ProductReviewDetailView.as_view(), name='product_review_detail'),
+    path('reviews/<int:pk>/helpful/', ProductReviewHelpfulView.as_view(), name='product_review_helpful'),
     path('get_random_product/', GetOneRandomProductView.as_view(), name='get_random_product'),
     # path('performance_comparison/', PerformanceComparisonView.as_view(), name='performance_comparison'),
 ]
\ No newline at end of file
@@ -1,24 +1,42 @@
-from random import choice
+import json
 import time
 
+from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Q, Avg, Count
+from django.http import HttpResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Avg, Count, Exists, OuterRef, prefetch_related_objects
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.filters import OrderingFilter
 from rest_framework.generics import ListAPIView
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.utils.encoders import JSONEncoder
 
+from common.cache import cached
 from order.models import CartItem, Cart, Order
-from order.serializers import CartSerializer
+from order.serializers import CartSerializer, cart_items_prefetch
 from user.models import MyUser
 from .serializers import *
-from .models import Product, Category, Company, ProductReview
+from .models import Product, Category, Company, ProductReview, parse_tags
+from .catalog import (
+    CATALOG_SNAPSHOT_TIMEOUT, PRODUCT_DETAIL_TIMEOUT, filter_category_subtree, get_catalog_snapshot,
+    get_category_tree, get_listing_version, pick_random_product, product_detail_key, site_origin,
+    site_request,
+)
+from .pagination import ProductCursorPagination, ReviewCursorPagination
+from .filters import ProductSearchFilter, RelevanceOrderingFilter
+from .search import did_you_mean
+from .autocomplete import prefix_index
+from .facets import compute_facets
+from .reviews import PRODUCT_HISTOGRAM_FIELDS, apply_rating_change
+from .helpful import pending_helpful_counts, vote_helpful
+from .holds import hold_stock
 
 
 
@@ -28,7 +46,12 @@ class MainPageView(APIView):
         operation_description="Get main page data with categories, products and cart",
         manual_parameters=[
             openapi.Parameter('category', openapi.IN_QUERY,
-                              description="Filter products by category ID", type=openapi.TYPE_INTEGER)
+                              description="Filter products by category ID", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('tag', openapi.IN_QUERY,
+                              description="Filter products by tag name", type=openapi.TYPE_STRING),
+            openapi.Parameter('category_tree', openapi.IN_QUERY,
+                              description="Filter products by category ID including its subcategories",
+                              type=openapi.TYPE_INTEGER)
         ],
         responses={
             200: openapi.Response(
@@ -59,36 +82,33 @@ class MainPageView(APIView):
         }
     )
     def get(self, request):
-        categories = Category.objects.all()
-        category_list_serializer = CategoryListSerializer(categories, many=True, context={'request': request})
-
         category_id = request.query_params.get('category', None)
-        if category_id:
-            try:
-                products = Product.objects.filter(category_id=int(category_id))
-            except ValueError:
-                return Response({
-                    'error': 'Неверный ID категории'
-                }, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            products = Product.objects.all()
+        category_tree = request.query_params.get('category_tree', None)
+        try:
+            category_id = int(category_id) if category_id else None
+            category_tree = int(category_tree) if category_tree else None
+        except ValueError:
+            return Response({
+                'error': 'Неверный ID категории'
+            }, status=status.HTTP_400_BAD_REQUEST)
 
-        products_list_serializer = ProductListSerializer(products, many=True, context={'request': request})
+        tags = parse_tags(request.query_params.get('tag'))
+        snapshot = get_catalog_snapshot(request, category_id, tags[0] if tags else None, category_tree)
 
         cart = None
 
         if request.user.is_authenticated:
             cart, created = Cart.objects.get_or_create(user=request.user, is_active=True)
 
-        cart_serializer = CartSerializer(cart) if cart else None
+        cart_data = None
+        if cart:
+            prefetch_related_objects([cart], *cart_items_prefetch())
+            cart_data = CartSerializer(cart).data
+        cart_json = json.dumps(cart_data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
 
-        data = {
-            'categories': category_list_serializer.data,
-            'products': products_list_serializer.data,
-            'cart': cart_serializer.data if cart_serializer else None,
-        }
-
-        return Response(data, status=status.HTTP_200_OK)
+        # The catalog part is already encoded, only the cart is serialized per request
+        body = b'{' + snapshot + b',"cart":' + cart_json.encode('utf-8') + b'}'
+        return HttpResponse(body, content_type='application/json', status=status.HTTP_200_OK)
 
     @swagger_auto_schema(
         tags=['main_page'],
@@ -147,26 +167,63 @@ class MainPageView(APIView):
 
         new_quantity = cart_item.quantity + quantity
 
+        if settings.STOCK_HOLDS_ENABLED:
+            held, free = hold_stock(product.id, cart.id, new_quantity, product.stock_quantity)
+            if not held:
+                if created:
+                    cart_item.delete()
+                return Response({
+                    'error': f'Недостаточно товара на складе. Доступно: {free}'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
         if new_quantity <= 0:
             cart_item.delete()
         else:
             cart_item.quantity = new_quantity
             cart_item.save()
 
+        prefetch_related_objects([cart], *cart_items_prefetch())
         cart_serializer = CartSerializer(cart)
         return Response(cart_serializer.data, status=status.HTTP_200_OK)
 
 
+class CategoryTreeView(APIView):
+    @swagger_auto_schema(
+        tags=['main_page'],
+        operation_description="Get the whole category tree with product counts",
+        responses={
+            200: openapi.Response(
+                description="Category tree",
+                examples={
+                    "application/json": [
+                        {"id": 1, "name": "Food", "image": None, "depth": 0, "product_count": 0,
+                         "total_product_count": 12, "children": [
+                             {"id": 2, "name": "Burgers", "image": None, "depth": 1, "product_count": 12,
+                              "total_product_count": 12, "children": []}
+                         ]}
+                    ]
+                }
+            )
+        }
+    )
+    def get(self, request):
+        return Response(get_category_tree(request), status=status.HTTP_200_OK)
+
+
 class ProductSearchView(ListAPIView):
     serializer_class = ProductListSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, RelevanceOrderingFilter]
     filterset_fields = ['category', 'company', 'is_available']
-    search_fields = ['name', 'description', 'tags', 'search_keywords']
     ordering_fields = ['name', 'original_price', 'rating', 'created_at']
     ordering = ['-created_at']
+    pagination_class = ProductCursorPagination
     
     def get_queryset(self):
-        queryset = Product.objects.filter(is_available=True)
+        queryset = (
+            Product.objects.filter(is_available=True)
+            .select_related('category', 'company')
+            .prefetch_related(primary_image_prefetch())
+        )
         
         # Filter by price range
         min_price = self.request.query_params.get('min_price')
@@ -197,14 +254,49 @@ class ProductSearchView(ListAPIView):
         if in_stock and in_stock.lower() == 'true':
             queryset = queryset.filter(stock_quantity__gt=0)
         
+        # Filter by category subtree
+        category_tree = self.request.query_params.get('category_tree')
+        if category_tree:
+            try:
+                queryset = filter_category_subtree(queryset, int(category_tree))
+            except ValueError:
+                pass
+        
+        # Filter by tags; every ?tag= must match
+        for tag in self.request.query_params.getlist('tag'):
+            names = parse_tags(tag)
+            if names:
+                queryset = queryset.filter(tag_set__name=names[0])
+        
         return queryset
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+
+        search_filter = ProductSearchFilter()
+        term = search_filter.get_search_term(request)
+        if term and search_filter.is_fuzzy(request):
+            # Best matches regardless of the requested ordering
+            best = list(queryset.order_by('-rank').values_list('name', 'tags')[:5])
+            response.data['suggestions'] = list(dict.fromkeys(name for name, _ in best))
+            response.data['did_you_mean'] = did_you_mean(term, [f'{name} {tags or ""}' for name, tags in best])
+
+        if request.query_params.get('facets', '').lower() in ('1', 'true'):
+            response.data['facets'] = compute_facets(queryset)
+        return response
     
     @swagger_auto_schema(
         tags=['product'],
         operation_description="Search and filter products",
         manual_parameters=[
             openapi.Parameter('search', openapi.IN_QUERY,
-                            description="Search term", type=openapi.TYPE_STRING),
+                            description="Search term, results are ranked by relevance", type=openapi.TYPE_STRING),
+            openapi.Parameter('fuzzy', openapi.IN_QUERY,
+                            description="Typo-tolerant matching; adds 'suggestions' and 'did_you_mean'",
+                            type=openapi.TYPE_BOOLEAN),
             openapi.Parameter('category', openapi.IN_QUERY,
                             description="Filter by category ID", type=openapi.TYPE_INTEGER),
             openapi.Parameter('company', openapi.IN_QUERY,
@@ -217,14 +309,68 @@ class ProductSearchView(ListAPIView):
                             description="Minimum rating", type=openapi.TYPE_NUMBER),
             openapi.Parameter('in_stock', openapi.IN_QUERY,
                             description="Only show in-stock items", type=openapi.TYPE_BOOLEAN),
+            openapi.Parameter('tag', openapi.IN_QUERY,
+                            description="Filter by tag name (repeatable, all must match)", type=openapi.TYPE_STRING),
+            openapi.Parameter('category_tree', openapi.IN_QUERY,
+                            description="Filter by category ID including its subcategories", type=openapi.TYPE_INTEGER),
             openapi.Parameter('ordering', openapi.IN_QUERY,
                             description="Order by field", type=openapi.TYPE_STRING),
+            openapi.Parameter('facets', openapi.IN_QUERY,
+                            description="Include counts per category, company, price and rating bucket",
+                            type=openapi.TYPE_BOOLEAN),
+            openapi.Parameter('cursor', openapi.IN_QUERY,
+                            description="Cursor from the 'next' link of the previous page", type=openapi.TYPE_STRING),
+            openapi.Parameter('page_size', openapi.IN_QUERY,
+                            description="Results per page (max 100)", type=openapi.TYPE_INTEGER),
         ]
     )
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
 
+class AutocompleteView(APIView):
+    max_limit = 20
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Search-as-you-type suggestions: product names, tags and restaurants matching a prefix",
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY,
+                              description="Prefix typed so far", type=openapi.TYPE_STRING, required=True),
+            openapi.Parameter('limit', openapi.IN_QUERY,
+                              description="Maximum number of suggestions (default 10, max 20)", type=openapi.TYPE_INTEGER),
+        ],
+        responses={
+            200: openapi.Response(
+                description="Suggestions",
+                examples={
+                    "application/json": {
+                        "query": "bur",
+                        "results": [
+                            {"type": "product", "id": 1, "text": "Burger"},
+                            {"type": "restaurant", "id": 2, "text": "Burger House"},
+                            {"type": "tag", "id": None, "text": "burgers"}
+                        ]
+                    }
+                }
+            )
+        }
+    )
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 10)), self.max_limit))
+        except ValueError:
+            return Response({
+                'error': 'Неверный limit'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'query': query,
+            'results': prefix_index.lookup(query, limit),
+        }, status=status.HTTP_200_OK)
+
+
 class ProductDetailView(APIView):
     @swagger_auto_schema(
         tags=['product'],
@@ -236,13 +382,12 @@ class ProductDetailView(APIView):
         }
     )
     def get(self, request, pk):
-        cache_key = f'product_detail_{pk}'
-        cached_product = cache.get(cache_key)
-        if cached_product:
-            return Response(cached_product, status=status.HTTP_200_OK)
+        def serialize():
+            product = Product.objects.select_related('company').prefetch_related('images').get(pk=pk)
+            return ProductDetailSerializer(product, context={'request': site_request(request)}).data
 
         try:
-            product = Product.objects.get(pk=pk)
+            data = cached(product_detail_key(pk), serialize, ttl=PRODUCT_DETAIL_TIMEOUT)
         except Product.DoesNotExist:
             return Response({
                 'error': 'Продукт не найден'
@@ -252,16 +397,206 @@ class ProductDetailView(APIView):
                 'error': 'Неверный ID продукта'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        serializer = ProductDetailSerializer(product, context={'request': request})
-        cache.set(cache_key, serializer.data, timeout=10)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class ProductReviewsView(APIView):
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    # Read by ReviewCursorPagination to pick the keyset ordering
+    filter_backends = [OrderingFilter]
+    ordering_fields = ['created_at', 'helpful_count']
+    ordering = ['-created_at']
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="List reviews of a product with its star histogram",
+        manual_parameters=[
+            openapi.Parameter('ordering', openapi.IN_QUERY,
+                              description="-created_at (default) or -helpful_count", type=openapi.TYPE_STRING),
+            openapi.Parameter('cursor', openapi.IN_QUERY,
+                              description="Cursor of the next page", type=openapi.TYPE_STRING),
+            openapi.Parameter('page_size', openapi.IN_QUERY,
+                              description="Reviews per page (max 50)", type=openapi.TYPE_INTEGER),
+        ],
+        responses={200: "Reviews page with rating histogram", 404: "Product not found"}
+    )
+    def get(self, request, pk):
+        try:
+            product = Product.objects.only('id', 'rating', 'rating_count', *PRODUCT_HISTOGRAM_FIELDS).get(pk=pk)
+        except Product.DoesNotExist:
+            return Response({
+                'error': 'Продукт не найден'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        paginator = ReviewCursorPagination()
+        reviews = ProductReview.objects.filter(product=product).select_related('user')
+        page = paginator.paginate_queryset(reviews, request, view=self)
+        pending = pending_helpful_counts(review.id for review in page)
+        serializer = ProductReviewSerializer(page, many=True, context={'pending_helpful': pending})
+        response = paginator.get_paginated_response(serializer.data)
+
+        # Histogram comes from the counters on the product row, not from the reviews table
+        response.data['rating'] = product.rating
+        response.data['rating_count'] = product.rating_count
+        response.data['histogram'] = product.rating_histogram
+        return response
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Leave a review on a product (one per user)",
+        request_body=ProductReviewSerializer,
+        responses={
+            201: ProductReviewSerializer,
+            400: "Invalid data or review already exists",
+            404: "Product not found"
+        }
+    )
+    def post(self, request, pk):
+        try:
+            product = Product.objects.get(pk=pk)
+        except Product.DoesNotExist:
+            return Response({
+                'error': 'Продукт не найден'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = ProductReviewSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        is_verified_purchase = Order.objects.filter(
+            user=request.user, status='delivered', items__product=product
+        ).exists()
+
+        try:
+            with transaction.atomic():
+                review = serializer.save(
+                    product=product, user=request.user, is_verified_purchase=is_verified_purchase
+                )
+                apply_rating_change(product, added=review.rating)
+        except IntegrityError:
+            return Response({
+                'error': 'Вы уже оставили отзыв на этот продукт'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(ProductReviewSerializer(review).data, status=status.HTTP_201_CREATED)
+
+
+class ProductReviewDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Edit your review",
+        request_body=ProductReviewSerializer,
+        responses={
+            200: ProductReviewSerializer,
+            400: "Invalid data",
+            404: "Review not found"
+        }
+    )
+    def put(self, request, pk):
+        with transaction.atomic():
+            # Lock the review so the rating being replaced is the one the aggregates hold
+            review = ProductReview.objects.select_for_update().filter(pk=pk, user=request.user).first()
+            if review is None:
+                return Response({
+                    'error': 'Отзыв не найден'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            old_rating = review.rating
+            serializer = ProductReviewSerializer(review, data=request.data, partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            review = serializer.save()
+
+            if review.rating != old_rating:
+                apply_rating_change(review.product, added=review.rating, removed=old_rating)
+
+        return Response(ProductReviewSerializer(review).data, status=status.HTTP_200_OK)
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Delete your review",
+        responses={
+            204: "Review deleted",
+            404: "Review not found"
+        }
+    )
+    def delete(self, request, pk):
+        with transaction.atomic():
+            review = ProductReview.objects.select_for_update().filter(pk=pk, user=request.user).first()
+            if review is None:
+                return Response({
+                    'error': 'Отзыв не найден'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            # The aggregates are shifted by the post_delete receiver (product.signals)
+            review.delete()
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ProductReviewHelpfulView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Mark a review as helpful (once per user)",
+        responses={
+            200: openapi.Response(
+                description="Vote recorded",
+                examples={"application/json": {"helpful_count": 12, "voted": True}}
+            ),
+            400: "Own review",
+            404: "Review not found"
+        }
+    )
+    def post(self, request, pk):
+        review = ProductReview.objects.filter(pk=pk).only('id', 'user_id', 'helpful_count').first()
+        if review is None:
+            return Response({
+                'error': 'Отзыв не найден'
+            }, status=status.HTTP_404_NOT_FOUND)
+        if review.user_id == request.user.id:
+            return Response({
+                'error': 'Нельзя отметить собственный отзыв'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        voted = vote_helpful(review.id, request.user.id)
+        helpful_count = review.helpful_count + pending_helpful_counts([review.id]).get(review.id, 0)
+        return Response({'helpful_count': helpful_count, 'voted': voted}, status=status.HTTP_200_OK)
 
 
 class GetOneRandomProductView(APIView):
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Get one random product, optionally filtered",
+        manual_parameters=[
+            openapi.Parameter('available', openapi.IN_QUERY,
+                              description="Only available products", type=openapi.TYPE_BOOLEAN),
+            openapi.Parameter('category', openapi.IN_QUERY,
+                              description="Filter by category ID", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('company', openapi.IN_QUERY,
+                              description="Filter by company ID", type=openapi.TYPE_INTEGER),
+        ],
+        responses={200: ProductDetailSerializer, 404: "No matching products"}
+    )
     def get(self, request):
+        available = request.query_params.get('available', '').lower() in ('1', 'true')
+        try:
+            category_id = int(request.query_params.get('category') or 0) or None
+            company_id = int(request.query_params.get('company') or 0) or None
+        except ValueError:
+            return Response({
+                'error': 'Неверные параметры фильтра'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        product = pick_random_product(available, category_id, company_id)
+        if product is None:
+            return Response({
+                'error': 'Продукт не найден'
+            }, status=status.HTTP_404_NOT_FOUND)
 
-        products = Product.objects.all()
-        product = choice(list(products))
         serializer = ProductDetailSerializer(product)
 
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -418,23 +753,48 @@ class RestaurantListView(APIView):
         }
     )
     def get(self, request):
-        companies = Company.objects.all()
+        search = request.query_params.get('search', None)
+        category = request.query_params.get('category', None)
+
+        # Both filters are case-insensitive, so is the cache key
+        cache_key = (
+            f'restaurant_list_v{get_listing_version()}_{site_origin(request)}'
+            f'_{(search or "").lower()}_{(category or "").lower()}'
+        )
+        data = cache.get(cache_key)
+        if data is not None:
+            return Response(data, status=status.HTTP_200_OK)
+
+        companies = Company.objects.annotate(product_count=Count('products'))
         
         # Filter by search query (restaurant name)
-        search = request.query_params.get('search', None)
         if search:
             companies = companies.filter(name__icontains=search)
         
         # Filter by category
-        category = request.query_params.get('category', None)
         if category:
             # Get companies that have products in this category
             companies = companies.filter(
-                id__in=Product.objects.filter(category__name__iexact=category).values_list('company_id', flat=True)
-            ).distinct()
+                Exists(Product.objects.filter(company=OuterRef('pk'), category__name__iexact=category))
+            )
         
         # Order by rating (highest first)
-        companies = companies.order_by('-rating')
-        
-        serializer = CompanyListSerializer(companies, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        companies = list(companies.order_by('-rating'))
+
+        # Distinct category names of every listed company in one grouped query
+        company_categories = {}
+        rows = (
+            Product.objects.filter(company__in=[company.id for company in companies])
+            .values_list('company_id', 'category__name')
+            .distinct()
+            .order_by('company_id', 'category__name')
+        )
+        for company_id, category_name in rows:
+            company_categories.setdefault(company_id, []).append(category_name)
+
+        serializer = CompanyListSerializer(
+            companies, many=True, context={'request': site_request(request), 'company_categories': company_categories}
+        )
+        data = serializer.data
+        cache.set(cache_key, data, timeout=CATALOG_SNAPSHOT_TIMEOUT)
+        return Response(data, status=status.HTTP_200_OK)
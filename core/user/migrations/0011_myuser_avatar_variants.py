@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0010_transactions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='avatar_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -31,6 +31,8 @@ class MyUser(AbstractBaseUser):
     username = models.CharField(max_length=255)
     phone_number = models.CharField(max_length=255, blank=True, null=True)
     avatar = models.ImageField(upload_to='media/user_avatars/', blank=True, null=True)
+    # Resized copies, see product/images.py
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     address = models.TextField(max_length=255, blank=True, null=True)
     company = models.ForeignKey('product.Company', on_delete=models.SET_NULL, blank=True, null=True)
     created_date = models.DateTimeField(auto_now_add=True)
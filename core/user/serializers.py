@@ -104,6 +104,39 @@ class ProductCreationSerializer(serializers.ModelSerializer):
         fields = ('name', 'original_price', 'discounted_price', 'category', 'description', 'image', 'ingredients', 'grams')
 
 
+class ProductBulkFilterSerializer(serializers.Serializer):
+    company = serializers.IntegerField(required=False)
+    category = serializers.IntegerField(required=False)  # includes its subcategories
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, max_length=10000)
+
+    def validate(self, data):
+        if not data:
+            raise serializers.ValidationError("Specify company, category or ids.")
+        return data
+
+
+class ProductBulkPatchSerializer(serializers.Serializer):
+    discounted_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0,
+                                                required=False, allow_null=True)
+    # Sets discounted_price to original_price minus this percentage
+    discount_percent = serializers.DecimalField(max_digits=5, decimal_places=2, min_value=0, max_value=100,
+                                                required=False)
+    stock_quantity = serializers.IntegerField(min_value=0, required=False)
+    is_available = serializers.BooleanField(required=False)
+
+    def validate(self, data):
+        if not data:
+            raise serializers.ValidationError("Nothing to change.")
+        if 'discounted_price' in data and 'discount_percent' in data:
+            raise serializers.ValidationError("Use either discounted_price or discount_percent.")
+        return data
+
+
+class ProductBulkUpdateSerializer(serializers.Serializer):
+    filter = ProductBulkFilterSerializer()
+    patch = ProductBulkPatchSerializer()
+
+
 class ChangePasswordSerializer(serializers.Serializer):
     current_password = serializers.CharField(write_only=True, required=True)
     new_password = serializers.CharField(write_only=True, required=True)
@@ -29,5 +29,7 @@ urlpatterns = [
     path('manager/create_product/', ProductCreateView.as_view()),
     path('manager/update_product/', ProductUpdateView.as_view()),
     path('manager/delete_product/', ProductDeleteView.as_view()),
+    path('manager/import_products/', ProductImportView.as_view()),
+    path('manager/bulk_update_products/', ProductBulkUpdateView.as_view()),
 
 ]
\ No newline at end of file
@@ -1,3 +1,6 @@
+import csv
+import os
+
 from django.contrib.auth.hashers import make_password
 from django.utils import timezone
 from .tasks import *
@@ -7,6 +10,7 @@ from django.core.mail import send_mail
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework.generics import UpdateAPIView, CreateAPIView, DestroyAPIView
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -19,6 +23,7 @@ from .serializers import *
 from django.conf import settings
 from django.db import IntegrityError
 from django.core.cache import cache
+from common.cache import cached
 from .models import Transactions
 from .throttling import (
     OTPVerificationThrottle, 
@@ -28,6 +33,9 @@ from .throttling import (
     reset_otp_attempts
 )
 
+from product.bulk import apply_product_patch
+from product.catalog import filter_category_subtree
+from product.importer import import_products
 from product.models import Product
 
 
@@ -304,6 +312,7 @@ class UserBalanceTopUpView(UpdateAPIView):
             user.save()
 
             Transactions.objects.create(user=user, amount=amount)
+            cache.delete(f'transactions_history_{user.id}')
 
             return Response({
                 'balance': user.balance,
@@ -318,15 +327,12 @@ class UserBalanceTopUpView(UpdateAPIView):
 class UserTransactionHistoryView(APIView):
     permission_classes = [IsAuthenticated]
     def get(self, request):
-        cache_key = f'transactions_history_{request.user.id}'
-        cached_data = cache.get(cache_key)
-        if cached_data:
-            return Response(cached_data, status=status.HTTP_200_OK)
+        def serialize():
+            transactions = Transactions.objects.filter(user=request.user)
+            return UserTransactionHistorySerializer(transactions, many=True).data
 
-        transactions = Transactions.objects.filter(user=request.user)
-        serializer = UserTransactionHistorySerializer(transactions, many=True)
-        cache.set(cache_key, serializer.data)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        data = cached(f'transactions_history_{request.user.id}', serialize, ttl=60*5)
+        return Response(data, status=status.HTTP_200_OK)
 
 
 
@@ -918,6 +924,117 @@ class ProductDeleteView(DestroyAPIView):
             return Response({'error': 'Product not found.'}, status=status.HTTP_404_NOT_FOUND)
 
 
+class ProductImportView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Create or update the manager's company products from a CSV or JSONL file, "
+                              "matched by sku (manager-only operation). Columns: sku, name, original_price, "
+                              "category (name), and optionally description, discounted_price, ingredients, grams, "
+                              "stock_quantity, is_available, tags, search_keywords, image_url.",
+        manual_parameters=[
+            openapi.Parameter('file', openapi.IN_FORM, description="CSV or JSONL file",
+                              type=openapi.TYPE_FILE, required=True),
+            openapi.Parameter('format', openapi.IN_FORM, description="csv or jsonl, guessed from the file name by default",
+                              type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: openapi.Response(
+                description="Import report",
+                examples={
+                    "application/json": {
+                        "created": 790,
+                        "updated": 8,
+                        "error_count": 2,
+                        "errors": [{"line": 14, "errors": {"category": ["Unknown category \"Sushi\"."]}}]
+                    }
+                }
+            ),
+            400: openapi.Response(
+                description="Invalid file",
+                examples={
+                    "application/json": {"error": "Unsupported format \"xlsx\", use csv or jsonl."}
+                }
+            ),
+            403: openapi.Response(
+                description="Permission denied",
+                examples={
+                    "application/json": {"error": "not enough rights"}
+                }
+            )
+        },
+        security=[{"Bearer": []}]
+    )
+    def post(self, request):
+        if request.user.role != 'manager' or request.user.company_id is None:
+            return Response({'error': 'not enough rights'}, status=status.HTTP_403_FORBIDDEN)
+
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('format') or os.path.splitext(upload.name)[1].lstrip('.').lower()
+
+        try:
+            # Large uploads are spooled to disk by Django, the importer reads them row by row
+            report = import_products(upload.open('rb'), file_format, request.user.company)
+        except (ValueError, csv.Error) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report, status=status.HTTP_200_OK)
+
+
+class ProductBulkUpdateView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        tags=['product'],
+        operation_description="Change price, stock or availability of many of the manager's company products "
+                              "at once (manager-only operation). `filter.category` includes its subcategories; "
+                              "`patch.discount_percent` sets discounted_price from original_price, 0 clears it.",
+        request_body=ProductBulkUpdateSerializer,
+        responses={
+            200: openapi.Response(
+                description="Products updated",
+                examples={
+                    "application/json": {"updated": 300}
+                }
+            ),
+            400: openapi.Response(
+                description="Invalid input",
+                examples={
+                    "application/json": {"patch": {"non_field_errors": ["Nothing to change."]}}
+                }
+            ),
+            403: openapi.Response(
+                description="Permission denied",
+                examples={
+                    "application/json": {"error": "not enough rights"}
+                }
+            )
+        },
+        security=[{"Bearer": []}]
+    )
+    def post(self, request):
+        if request.user.role != 'manager' or request.user.company_id is None:
+            return Response({'error': 'not enough rights'}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = ProductBulkUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        product_filter = serializer.validated_data['filter']
+        if product_filter.get('company', request.user.company_id) != request.user.company_id:
+            return Response({'error': 'not enough rights'}, status=status.HTTP_403_FORBIDDEN)
+
+        products = Product.objects.filter(company_id=request.user.company_id)
+        if 'category' in product_filter:
+            products = filter_category_subtree(products, product_filter['category'])
+        if 'ids' in product_filter:
+            products = products.filter(pk__in=product_filter['ids'])
+
+        updated = apply_product_patch(products, serializer.validated_data['patch'])
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
+
+
 #ACCOUNT MANAGEMENT
 
 class ChangePasswordView(APIView):